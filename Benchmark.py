@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+#****************************************************************************#
+#                                                                            #
+#                                                                            #
+#                     Acquisition Throughput Benchmark                       #
+#                                                                            #
+#                                                                            #
+#****************************************************************************#
+#
+# Runs Data_acq.py against the DI-1100 emulator and reports the sustained
+# sample rate, the CPU time spent by the acquisition process and any
+# dropped or misaligned data.
+#
+import argparse
+import glob
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from dataq_utilities.emulator import emulator
+from dataq_utilities.compressed import open_recording
+
+print('Using Python: {:1d}.{:1d}'
+      .format(sys.version_info[0], sys.version_info[1]))
+#
+#****************************************************************************#
+#
+# Parse Command Line Arguments
+#
+parser = argparse.ArgumentParser(description='DI-1100 acquisition benchmark')
+parser.add_argument('-c', '--channel', default=[0,1,2], type=int, nargs='+',
+                    help='Channel [0,1,2,3]', required=False)
+parser.add_argument('-r', '--rate', default=10000, type=int,
+                    help='Sampling Rate (sps)', required=False)
+parser.add_argument('-t', '--time', default=5, type=float,
+                    help='Length (sec)', required=False)
+parser.add_argument('-R', '--runs', default=1, type=int,
+                    help='Number of runs', required=False)
+parser.add_argument('-w', '--waveform', default='ramp', type=str,
+                    help='Emulator waveform [ramp, sine]', required=False)
+parser.add_argument('-a', '--args', default='', type=str,
+                    help='Extra arguments for Data_acq.py', required=False)
+
+args = parser.parse_args()
+
+channel = args.channel
+desired_rate = args.rate
+acq_duration = args.time
+runs = args.runs
+waveform = args.waveform
+extra_args = args.args.split()
+
+here = os.path.dirname(os.path.abspath(__file__))
+script = os.path.join(here, 'Data_acq.py')
+env = dict(os.environ)
+env['PYTHONPATH'] = here + os.pathsep + env.get('PYTHONPATH', '')
+#
+#****************************************************************************#
+#
+# One benchmark run
+#
+def run_once():
+    device = emulator(slist=channel, waveform=waveform)
+    device.start()
+    workdir = tempfile.mkdtemp(prefix='dataq_bench_')
+    command = [sys.executable, script,
+               '-p', device.port,
+               '-r', str(desired_rate),
+               '-t', str(acq_duration),
+               '-c'] + [str(c) for c in channel] + extra_args
+
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    launch = time.perf_counter()
+    proc = subprocess.run(command, cwd=workdir, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    finish = time.perf_counter()
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    device.close()
+
+    result = {}
+    result['returncode'] = proc.returncode
+    result['wall'] = finish - launch
+    result['cpu_user'] = usage_after.ru_utime - usage_before.ru_utime
+    result['cpu_sys'] = usage_after.ru_stime - usage_before.ru_stime
+    result['dropped_bytes'] = device.dropped_bytes
+    result['overflows'] = device.overflows
+    result['output'] = proc.stdout.decode(errors='replace')
+
+    if device.start_time is not None:
+        result['setup'] = device.start_time - launch
+        stop_time = device.stop_time or finish
+        streamed = stop_time - device.start_time
+        result['streamed'] = streamed
+        result['samples_per_sec'] = (device.scans_sent * len(device.slist)
+                                     / streamed)
+
+    # Compare what was written against what the emulator sent
+    files = glob.glob(os.path.join(workdir, '*.wav')) + \
+        glob.glob(os.path.join(workdir, '*.dqz'))
+    result['scans'] = 0
+    result['misaligned'] = 0
+    for name in sorted(files, key=os.path.getmtime):
+        with open_recording(name) as rec:
+            data = np.asarray(rec.data)
+        expected = device.scan_values(result['scans'], len(data),
+                                      nchan=data.shape[1])
+        result['misaligned'] += int(np.any(data != expected, axis=1).sum())
+        result['scans'] += len(data)
+    # Recordings and their overview files
+    shutil.rmtree(workdir)
+    return result
+#
+#****************************************************************************#
+#
+# Run the benchmark and report
+#
+print('')
+print('** Benchmark:')
+print('\t Channels {} at {} Hz for {} seconds, {} run(s)'
+      .format(channel, desired_rate, acq_duration, runs))
+print('')
+
+results = []
+for n in range(runs):
+    r = run_once()
+    results.append(r)
+    if r['returncode'] != 0 or 'samples_per_sec' not in r:
+        print('Run {}: Data_acq.py failed'.format(n))
+        print(r['output'])
+        continue
+    print('Run {}: {:10.0f} samples/s  setup {:6.3f} s  '
+          'cpu {:6.3f} s (user {:.3f}, sys {:.3f})'
+          .format(n, r['samples_per_sec'], r['setup'],
+                  r['cpu_user'] + r['cpu_sys'], r['cpu_user'], r['cpu_sys']))
+    print('\t scans written {}  misaligned {}  dropped bytes {}  '
+          'overflows {}'.format(r['scans'], r['misaligned'],
+                                r['dropped_bytes'], r['overflows']))
+
+good = [r for r in results
+        if r['returncode'] == 0 and 'samples_per_sec' in r]
+if good:
+    print('')
+    print('Mean: {:10.0f} samples/s  cpu {:6.3f} s per run  '
+          'cpu/sample {:.3f} us'
+          .format(np.mean([r['samples_per_sec'] for r in good]),
+                  np.mean([r['cpu_user'] + r['cpu_sys'] for r in good]),
+                  1e6 * np.sum([r['cpu_user'] + r['cpu_sys'] for r in good])
+                  / max(1, np.sum([r['scans'] * len(channel) for r in good]))))
+
+sys.exit()
@@ -11,13 +11,19 @@ import argparse
 import serial
 import time
 import sys
-import numpy as np
-from scipy.io import wavfile
-from datetime import date, datetime
-import array as arr
 
 # Is there a better way to do this?
 from dataq_utilities.serial_commands import dataq
+from dataq_utilities.pipeline import pipeline, capture, stats, tee
+from dataq_utilities.wav_writer import wav_writer
+from dataq_utilities.compressed import compressed_writer
+from dataq_utilities.decimation import plan_decimation, multirate, FILTERS
+from dataq_utilities.trigger import trigger, triggered_capture, KINDS, EDGES, \
+    REARM
+from dataq_utilities.shared_stream import stream_publisher
+from dataq_utilities.daemon import acquisition_daemon
+from dataq_utilities.multi_device import device_group
+from dataq_utilities.telemetry import telemetry
 DataQ = dataq()
 
 print('Using Python: {:1d}.{:1d}'
@@ -28,7 +34,7 @@ print('Using Python: {:1d}.{:1d}'
 # Parse Command Line Arguments
 #
 parser = argparse.ArgumentParser(description='DI-1100')
-parser.add_argument('-c', '--channel', default=[0,1,2], type=int,
+parser.add_argument('-c', '--channel', default=[0,1,2], type=int, nargs='+',
                     help='Channel [0,1,2,3]', required=False)
 parser.add_argument('-r', '--rate', default=10000, type=int,
                     help='Sampling Rate (sps)', required=False)
@@ -38,6 +44,69 @@ parser.add_argument('-D', '--debug', default=0, type=int,
                     help='Debug level', required=False)
 parser.add_argument('-n', '--nsamp', default=0, type=int,
                     help='Length (samples)', required=False)
+parser.add_argument('-s', '--split-size', default=0, type=float,
+                    help='New file every N megabytes (0: never)',
+                    required=False)
+parser.add_argument('-S', '--split-time', default=0, type=float,
+                    help='New file every N seconds (0: never)', required=False)
+parser.add_argument('-L', '--latency', default=0.05, type=float,
+                    help='Max read latency (sec)', required=False)
+parser.add_argument('-j', '--metrics', default='', type=str,
+                    help='Write acquisition metrics to this JSON file',
+                    required=False)
+parser.add_argument('-F', '--format', default='wav', type=str,
+                    help='Output format: wav or dqz (compressed, indexed)',
+                    required=False)
+parser.add_argument('-o', '--overview', default=1, type=int,
+                    help='Write a min/max overview file per recording (1)',
+                    required=False)
+parser.add_argument('-e', '--edges', default=1, type=int,
+                    help='Write a digital input edge index per recording (1)',
+                    required=False)
+parser.add_argument('-f', '--filter', default='last', type=str,
+                    help='Device decimation filter: last, avg, max or min',
+                    required=False)
+parser.add_argument('-M', '--multirate', default=[], type=float, nargs='+',
+                    help='Also record at these rates (Hz), e.g. 100',
+                    required=False)
+parser.add_argument('-W', '--full-rate', default=1, type=int,
+                    help='Record the full rate stream (0: -M rates only)',
+                    required=False)
+parser.add_argument('-T', '--trigger', default='', type=str,
+                    help='Triggered capture: level, slope or digital',
+                    required=False)
+parser.add_argument('-g', '--trigger-channel', default=0, type=int,
+                    help='Trigger scan list position', required=False)
+parser.add_argument('-l', '--trigger-level', default=0.0, type=float,
+                    help='Trigger level (V, V/s or DI bit)', required=False)
+parser.add_argument('-E', '--edge', default='rising', type=str,
+                    help='Trigger edge: rising, falling or both',
+                    required=False)
+parser.add_argument('-B', '--pre', default=0.1, type=float,
+                    help='Pre-trigger window (sec)', required=False)
+parser.add_argument('-A', '--post', default=0.4, type=float,
+                    help='Post-trigger window (sec)', required=False)
+parser.add_argument('-R', '--rearm', default='auto', type=str,
+                    help='Re-arm: auto, single or retrigger', required=False)
+parser.add_argument('-H', '--holdoff', default=0.0, type=float,
+                    help='Dead time after each window (sec)', required=False)
+parser.add_argument('-N', '--events', default=0, type=int,
+                    help='Stop triggering after N events (0: never)',
+                    required=False)
+parser.add_argument('-O', '--one-file', default=0, type=int,
+                    help='Triggered windows as records of one file (1)',
+                    required=False)
+parser.add_argument('-P', '--publish', default='', type=str,
+                    help='Publish the live stream in shared memory NAME',
+                    required=False)
+parser.add_argument('-p', '--port', default='', type=str,
+                    help='Serial port(s), comma separated (default: discover)',
+                    required=False)
+parser.add_argument('-m', '--multi', default=0, type=int,
+                    help='Synchronized capture from all devices (1)',
+                    required=False)
+parser.add_argument('-d', '--daemon', default='', type=str,
+                    help='Run as a daemon on this Unix socket', required=False)
 
 args = parser.parse_args()
 
@@ -46,15 +115,117 @@ desired_rate = args.rate
 acq_duration = args.time
 DEBUG = args.debug
 nsamp_acq = args.nsamp
+port = args.port
+daemon_socket = args.daemon
+max_latency = args.latency
+metrics_file = args.metrics
+multi = args.multi
+split_size = args.split_size
+split_time = args.split_time
+overview = args.overview
+edges = args.edges
+publish = args.publish
+if args.format not in ('wav', 'dqz'):
+    print('** ERROR: bad format. Try: wav, dqz')
+    sys.exit()
+writer_class = compressed_writer if args.format == 'dqz' else wav_writer
+trigger_kind = args.trigger
+if trigger_kind != '' and (trigger_kind not in KINDS or
+                           args.edge not in EDGES or
+                           args.rearm not in REARM):
+    print('** ERROR: bad trigger. Try: \n', KINDS, EDGES, REARM)
+    sys.exit()
+
+#
+# In triggered mode (-T) only the windows around events reach the writer
+#
+
+def triggered(writer):
+    if trigger_kind == '':
+        return writer
+    condition = trigger(writer.rate, trigger_kind, args.trigger_channel,
+                        args.trigger_level, args.edge)
+    return triggered_capture(writer, condition, args.pre, args.post,
+                             args.rearm, args.holdoff, args.events or None,
+                             per_event=args.one_file != 1)
+
+def report_events(recorder):
+    if trigger_kind == '':
+        return
+    print('Triggered windows: {}'.format(len(recorder.events)))
+    for event in recorder.events:
+        print('  {trigger_time:.4f} s: {scans} scans in {file}'
+              .format(**event))
 if (nsamp_acq != 0):
     acq_duration = nsamp_acq / desired_rate
 #
 #****************************************************************************#
 #
+# Several devices: configure them in parallel, start them together and
+# merge their channels (device by device) into one recording
+#
+if (multi == 1):
+    # Device decimation and multirate outputs are planned for a single
+    # device only
+    if (args.filter != 'last' or args.multirate or args.full_rate != 1):
+        print('** ERROR: -f, -M and -W are not supported with -m 1')
+        sys.exit()
+    # Acquisition metrics are collected per pipeline, for one device
+    if (metrics_file != ''):
+        print('** ERROR: -j is not supported with -m 1')
+        sys.exit()
+    if (port == ''):
+        ports = DataQ.discover_devices()
+    else:
+        ports = port.split(',')
+    if (len(ports) == 0):
+        print('No DataQ devices found. Exiting')
+        sys.exit()
+    print('Found DataQ devices on', ', '.join(ports))
+    group = device_group(ports, channel, desired_rate,
+                         max_latency=max_latency)
+    Fs = group.open()
+    Max_Samples = int(Fs * acq_duration)
+    all_channels = channel * len(ports)
+    print('** Acquiring {} channels at {} Hz, {} samples'
+          .format(len(all_channels), Fs, Max_Samples))
+    writer = writer_class(desired_rate, all_channels,
+                          max_bytes=int(split_size * 2**20) or None,
+                          max_seconds=split_time or None,
+                          overview=overview == 1, edges=edges == 1)
+    start = time.time()
+    recorder = triggered(writer)
+    sink = recorder
+    if publish != '':
+        # Local processes read the merged scans live (shared_stream.py)
+        publisher = stream_publisher(publish, len(all_channels), Fs)
+        sink = tee(publisher, recorder)
+    try:
+        merged = group.capture(Max_Samples, sink)
+    except RuntimeError as err:
+        # The files hold what was merged before the failure
+        print('** ERROR: {}'.format(err))
+        merged = None
+    stop = time.time()
+    group.close()
+    print('Acquisition time: {} seconds'.format(stop-start))
+    if merged is not None:
+        print('Start skew [ms]: {}'.format(
+            ['{:.3f}'.format(1000 * s) for s in (merged.skew or [])]))
+    for filename in writer.files:
+        print('Wrote {}'.format(filename))
+    report_events(recorder)
+    sys.exit()
+#
+#****************************************************************************#
+#
 # Finding a DataQ device and setting it up
 #
 ser = serial.Serial()
-ser.port = DataQ.discover_device()
+if (port == ''):
+    ser.port = DataQ.discover_device()
+else:
+    ser.port = port
 if (ser.port == None):
     print('No DataQ devices found. Exiting')
     sys.exit()
@@ -65,30 +236,51 @@ else:
     ser.timeout = 0
     ser.open()
 
+# Daemon mode: keep the device open and configured, take capture jobs
+# over the socket until told to shut down
+if (daemon_socket != ''):
+    acquisition_daemon(ser, DataQ, daemon_socket,
+                       max_latency=max_latency).serve_forever()
+    ser.close()
+    sys.exit()
+
 DataQ.send_command(ser, 'info 1', False)      # Device model number
-DataQ.send_command(ser, 'stop', False)        # Stop scanning
-DataQ.send_command(ser, 'encode 0', False)    # Binary output
-DataQ.send_command(ser, 'ps 0', False)        # Packet size is 16 bytes
-DataQ.send_command(ser, 'dec 1', False)       # Primary decimation factor
-DataQ.send_command(ser, 'deca 1', False)      # Secondary decimation factor
-DataQ.send_command(ser, 'filter 0 0', False)  # filter arg0 arg1 where arg0-
-#channel number & arg1- 0,1,2 or 3 (last point, average, max, min resp.)
-DataQ.send_command(ser, 'filter 1 0', False)
-DataQ.send_command(ser, 'filter 2 0', False)
 
+# stop, binary output (encode 0), 16 byte packets (ps 0), device
+# decimation (dec 1, deca and the filter mode on each channel from the
+# plan), scan list and sampling rate, each checked against its echo
 slist = channel
-DataQ.config_scan_list(ser, slist)
-
-# Set up the sampling rate
-decimation_factor = 1
-Fs = DataQ.sampling_rate(ser, desired_rate, decimation_factor)
+if args.filter not in FILTERS:
+    print('** ERROR: bad filter. Try: \n', FILTERS)
+    sys.exit()
+# With a trigger the full rate is still streamed, and only the windows
+# around events are kept of it
+try:
+    plan = plan_decimation(desired_rate, args.multirate, args.filter,
+                           args.full_rate == 1 or trigger_kind != '',
+                           nchan=len(slist))
+except ValueError as err:
+    print('** ERROR: {}'.format(err))
+    sys.exit()
+decimation_factor = plan['deca']
+Fs = DataQ.configure(ser, slist, plan['rate'], decimation_factor,
+                     filter_mode=plan['filter_mode'], deca=plan['deca'],
+                     verbose=(DEBUG == 1))
 Max_Samples = int(Fs * acq_duration)
+print('Configured in {:.3f} seconds'.format(DataQ.configure_time))
+if (DEBUG == 1):
+    for command, rtt in DataQ.timings:
+        print('\t {:<12} {:8.3f} ms'.format(command, 1000 * rtt))
 
 print('')
 print('** Acquiring:')
 print('\t From channel {} at {} Hz'.format(slist, Fs))
 print('\t {} seconds, {} samples'.format(acq_duration, Max_Samples))
-print('\t decimation factor: {}'.format(decimation_factor))
+print('\t decimation factor: {} ({} filter)'.format(decimation_factor,
+                                                  plan['filter']))
+for o in plan['outputs']:
+    print('\t also at {:g} Hz (host decimation {})'
+          .format(o['actual'], ' x '.join(map(str, o['stages'])) or 'none'))
 print('')
 #
 #****************************************************************************#
@@ -99,54 +291,90 @@ nsamp_acq = 0
 scale_factor = 10 / 32768
 
 #waiting = arr.array('I')
-raw_samples=bytearray()
-num_samp_per_read=32    # best if Max_Samples/num_samp_per_read is integer
-num_bytes_per_read=6*num_samp_per_read
+# Reads drain whatever is buffered, sized from the backlog and the rate,
+# with at most max_latency seconds of data per block
+# Backlog / latency / gap metrics only when asked for (-j)
+metrics = telemetry(Fs, len(channel)) if metrics_file else None
+acq = pipeline(ser, len(channel), Fs=Fs, max_latency=max_latency,
+               telemetry=metrics)
+# Frames are streamed to WAV files as they arrive
+writer = writer_class(desired_rate, channel,
+                      max_bytes=int(split_size * 2**20) or None,
+                      max_seconds=split_time or None,
+                      overview=overview == 1, edges=edges == 1)
+recorder = triggered(writer)
+# Lower rates (-M) are decimated from the same stream, one file each
+rate_writers = [writer_class(int(o['rate']), channel,
+                             max_bytes=int(split_size * 2**20) or None,
+                             max_seconds=split_time or None,
+                             overview=overview == 1, edges=edges == 1)
+                for o in plan['outputs']]
+if rate_writers:
+    acq.add_sink(multirate(plan, len(channel),
+                           recorder if plan['full_rate'] else None,
+                           rate_writers))
+else:
+    acq.add_sink(recorder)
+statistics = acq.add_sink(stats(len(channel)))
+# Local processes read the live stream from shared memory (-P)
+if publish != '':
+    acq.add_sink(stream_publisher(publish, len(channel), Fs))
+if (DEBUG == 1):
+    captured = acq.add_sink(capture(Max_Samples, len(channel)))
 
+# Reader thread blocks on the port, consumer thread writes the files
 DataQ.send_command(ser, 'start', True)
 start = time.time()
-while (nsamp_acq < Max_Samples/num_samp_per_read):
-    if (ser.inWaiting() >= num_bytes_per_read):
-        # how many bytes waiting on link?
-        #waiting.append(ser.inWaiting())
-
-        raw_samples=raw_samples+ser.read(num_bytes_per_read)
-        nsamp_acq = nsamp_acq+1
+try:
+    acq.run(Max_Samples)
+except KeyboardInterrupt:
+    print('Interrupted, closing files')
+    acq.stop()
 
 stop = time.time()
 DataQ.send_command(ser, 'stop', False)
-time.sleep(1)
 ser.flushInput()
 ser.close()
 Acq_time = stop-start
 print('Acquisition time: {} seconds'.format(Acq_time))
+print('Overruns: {} (max queued blocks: {})'.format(acq.overruns,
+                                                    acq.max_queued))
+print('Misaligned: {} ({} bytes skipped)'.format(acq.decoder.misaligned,
+                                                 acq.decoder.skipped_bytes))
+print('Reads: {reads} ({mean_read_bytes:.0f} bytes on average)'
+      .format(**acq.policy.report()))
+if acq.stalled:
+    print('Device stopped sending data after {} scans'.format(acq.scans))
+if metrics is not None:
+    m = metrics.snapshot()
+    print('Effective Fs: {} (configured {})'.format(m['effective_Fs'], Fs))
+    print('Max backlog: {} bytes, buffer overflows: {}'
+          .format(m['max_backlog'], m['overflows']))
+    if m['block_latency'] is not None:
+        print('Block latency [ms]: p50 {:.2f} p99 {:.2f} max {:.2f}'
+              .format(*[1e3 * m['block_latency'][k]
+                        for k in ('p50', 'p99', 'max')]))
+    metrics.write_json(metrics_file)
+    print('Metrics written to {}'.format(metrics_file))
+print('Mean [V]: {}'.format(statistics.mean() * scale_factor))
 
 # np.savetxt("waiting.txt",waiting,fmt="%s")  # Saving the 'waiting' array as .txt file
 #
 #****************************************************************************#
 #
-# Saving the read data
-#
-# Typecasting
-raw_samples = raw_samples[0:Max_Samples*6]   # necessary if Max_Samples/num_samp_per_read is not integer
-xx = memoryview(raw_samples)
-yy = xx.cast('h',shape=[Max_Samples,len(channel)])
-samples_int16_resized = np.array(yy, dtype=np.int16, copy=False, ndmin=2)
-
-# Writing to a WAV file
-date = str(date.today())
-sampling_rate = str(desired_rate)
-channels = ''.join(map(str, channel))
-sequence_length = str(Max_Samples)
-currentDT = datetime.now()
-time = currentDT.strftime("%H-%M-%S")
-filename = (date+'_'+'SR'+sampling_rate+'_'+'SL'+sequence_length+'_'+'CH'+
-            channels+'_'+time+'.wav')
-wavfile.write(filename, desired_rate, samples_int16_resized)
+# Saved data
+#
+for w in [writer] + rate_writers:
+    for filename in w.files:
+        print('Wrote {}'.format(filename))
+report_events(recorder)
 
 if (DEBUG == 1):
-     for n in range(0,Max_Samples):
+     samples_int16_resized = captured.samples
+     for n in range(0,captured.nscans):
         print('s[{}] : {:2.4f} \t 0b|{:016b} \t 0x|{:04d}'.
-              format(n,samples_int16_resized[n],raw_samples[n]))
+              format(n,samples_int16_resized[n,0]*scale_factor,
+                     int(samples_int16_resized[n,0]) & 0xFFFF,
+                     samples_int16_resized[n,0]))
 
 sys.exit()
\ No newline at end of file
@@ -9,12 +9,19 @@
 #
 import matplotlib.pyplot as plt
 import numpy as np
-import scipy as sp
-from scipy import signal
-from scipy.io import wavfile
-from scipy.fftpack import fft, fftfreq
 import argparse
+import os
+import shutil
 import sys
+
+from dataq_utilities.recording import to_volts
+from dataq_utilities.compressed import open_recording
+from dataq_utilities.overview import overview_for
+from dataq_utilities.digital import edges_for
+from dataq_utilities.stft import stft, spectrogram_writer
+from dataq_utilities.spectrum import spectrum, zoom, welch, PADDING
+from dataq_utilities.batch import run_batch
+from dataq_utilities.cache import result_cache
 plt.style.use('classic')
 
 print('Using Python: {:1d}.{:1d}'
@@ -26,8 +33,15 @@ print('Using Python: {:1d}.{:1d}'
 #
 parser = argparse.ArgumentParser(
     description='Processing input file')
-#parser.add_argument('-i', '--input', default='dum', type=str,
-#                    help='Input file (WAV)', required=True)
+parser.add_argument('-i', '--input',
+                    default='2020-09-14_SR10000_SL200000_CH012_11-25-49.wav',
+                    type=str, help='Input file (WAV or .dqz)', required=False)
+parser.add_argument('-b', '--batch', default='', type=str,
+                    help='Process a directory or glob of files headlessly',
+                    required=False)
+parser.add_argument('-j', '--processes', default=0, type=int,
+                    help='Batch worker processes (0: all cores)',
+                    required=False)
 parser.add_argument('-f', '--frame', default=1024, type=int,
                     help='FFT frame length', required=False)
 parser.add_argument('-o', '--overlap', default=25, type=int,
@@ -38,6 +52,34 @@ parser.add_argument('-w', '--window', default='hann', type=str,
                     help='Window function', required=False)
 parser.add_argument('-C', '--colormap', default='inferno', type=str,
                     help='Plot filename', required=False)
+parser.add_argument('-p', '--padding', default='pow2', type=str,
+                    help='Spectrum FFT length: pow2 (x zeropad) or fast',
+                    required=False)
+parser.add_argument('-n', '--workers', default=-1, type=int,
+                    help='FFT worker threads (-1: all cores)', required=False)
+parser.add_argument('-Z', '--zoom', default=None, type=float, nargs=3,
+                    metavar=('FMIN', 'FMAX', 'NBINS'),
+                    help='High resolution spectrum of FMIN..FMAX Hz only',
+                    required=False)
+parser.add_argument('-P', '--psd', default=0, type=int,
+                    help='Welch PSD over the whole file (1)', required=False)
+parser.add_argument('-c', '--cache', default='', type=str,
+                    help='Cache analysis results in this directory',
+                    required=False)
+parser.add_argument('-M', '--cache-size', default=1024, type=float,
+                    help='Cache size limit (MB)', required=False)
+parser.add_argument('-t', '--time', default=None, type=float, nargs=2,
+                    metavar=('T0', 'T1'),
+                    help='Analyse T0..T1 seconds of the file only',
+                    required=False)
+parser.add_argument('-d', '--digital', default=None, type=int,
+                    help='Find the segments where digital input DIn is high',
+                    required=False)
+parser.add_argument('-k', '--segment', default=None, type=int,
+                    help='Analyse only segment K of -d', required=False)
+parser.add_argument('-O', '--output', default='', type=str,
+                    help='Write spectrograms (.npy) to this directory',
+                    required=False)
 
 args = parser.parse_args()
 
@@ -46,14 +88,85 @@ frame = args.frame
 overlap = min(args.overlap, 75)
 cmap = args.colormap
 window_type = args.window
+output_dir = args.output
+padding = args.padding
+workers = args.workers
+zoom_band = args.zoom
+psd = args.psd
+batch = args.batch
+processes = args.processes or None
+cache_dir = args.cache
+cache_size = args.cache_size
+time_window = args.time
+digital_bit = args.digital
+segment_k = args.segment
 
-wavefile = '2020-09-14_SR10000_SL200000_CH012_11-25-49.wav'
-#wavefile = args.input
-if (wavefile == 'dum'):
+wavefile = args.input
+if (batch != ''):
+    pass    # Files are opened by the batch workers
+elif (wavefile == 'dum'):
     print('Error: need input filename')
     sys.exit()
 else:
-    rate,received_data=wavfile.read(wavefile)
+    # Memory-mapped WAV or block-indexed .dqz: nothing is read until
+    # samples are used
+    rec = open_recording(wavefile)
+    rate = rec.rate
+
+    # Analysis window (-t): scans first..last, every stage below reads
+    # only these
+    if time_window is None:
+        first, last = 0, rec.nscans
+    else:
+        first = rec.scan(time_window[0])
+        last = max(rec.scan(time_window[1]), first + 1)
+        if first >= rec.nscans:
+            print('** ERROR: the file is only {:g} s long'
+                  .format(rec.duration))
+            sys.exit()
+        last = min(last, rec.nscans)
+
+    # Digital input segments (-d) come from the edge index (sidecar file,
+    # built on first use), not from the samples; -k narrows the window
+    # to one of them
+    segments = None
+    if digital_bit is not None:
+        segments = edges_for(rec).segments(digital_bit, 1, first, last)
+        print('DI{} high: {} segments'.format(digital_bit, len(segments)))
+        for n, (a, b) in enumerate(segments[:20]):
+            print('  {:3d}: {:.4f} - {:.4f} s'.format(n, a / float(rate),
+                                                     b / float(rate)))
+        if segment_k is not None:
+            if not 0 <= segment_k < len(segments):
+                print('** ERROR: no segment {}'.format(segment_k))
+                sys.exit()
+            first, last = (int(n) for n in segments[segment_k])
+            segments = segments[segment_k:segment_k + 1]
+            time_window = (first / float(rate), last / float(rate))
+    t_start = first / float(rate)
+    nscans = last - first
+
+    # Output files (-O) are named after the input, and the window
+    output_base = os.path.splitext(os.path.basename(wavefile))[0]
+    if time_window is not None:
+        output_base += '_{:g}-{:g}s'.format(t_start, last / float(rate))
+
+# Results of every stage are cached under the file's content hash and
+# the parameters that stage uses (batch workers open their own files)
+cache = None
+if (cache_dir != '' and batch == ''):
+    cache = result_cache(cache_dir, int(cache_size * 2**20))
+    digest = cache.file_hash(wavefile)
+
+def cached(stage, compute, **params):
+    if cache is None:
+        return compute()
+    key = cache.key(digest, stage, first=first, last=last, **params)
+    result = cache.load(key)
+    if result is None:
+        result = compute()
+        cache.store(key, **result)
+    return result
 
 # Validate window
 valid_windows = ['boxcar', 'triang', 'hann', 'hamming',
@@ -61,11 +174,24 @@ valid_windows = ['boxcar', 'triang', 'hann', 'hamming',
 if window_type not in valid_windows:
     print('** ERROR: bad window type. Try: \n', valid_windows)
     sys.exit()
+if padding not in PADDING:
+    print('** ERROR: bad padding. Try: \n', PADDING)
+    sys.exit()
 
 if (zeropad == 0):
     NFFT = frame
 else:
     NFFT = 2 ** int(np.ceil(np.log2(np.abs(frame*zeropad))))
+
+# Batch mode: every file in its own process, outputs and index.json in
+# the --output directory, no plots
+if (batch != ''):
+    index = run_batch(batch, output_dir or '.', processes, frame=frame,
+                      overlap=overlap, zeropad=zeropad, window=window_type,
+                      padding=padding)
+    print('Processed {} files ({} failed)'
+          .format(len(index), sum('error' in s for s in index)))
+    sys.exit()
 #
 #****************************************************************************#
 #
@@ -88,33 +214,42 @@ print('Total acquisiton time:',acquisition_time)
 print('Channels used:',channels)
 """
  
-# Seperating the channels
-chan_1=received_data[:,0]
-chan_2=received_data[:,1]
-chan_3=received_data[:,2]
-
-# Taking the embedded digital info from channel 1
-mask = 0xFFFC
-chan_1_masked = np.bitwise_and(chan_1,mask)
+# Floating the sample values of the window in float32: the embedded
+# digital info in channel 1 is masked off (0xFFFC) and counts are scaled
+# by 10/32768
+volts = rec.read(t_start, last / float(rate))
 
-# Floating the sample values
-scale_factor = 10 / 32768
-chan_1_float = np.int16(chan_1_masked) * scale_factor
-chan_2_float = np.array(chan_2) * scale_factor
-chan_3_float = np.array(chan_3) * scale_factor
+# Seperating the channels
+chan_1_float = volts[:,0]
+chan_2_float = volts[:,1]
+chan_3_float = volts[:,2]
 #
 #****************************************************************************#
 #
 # Time plot
 #
-acq_duration = len(chan_1) / rate
-t = sp.arange(0, acq_duration, 1/rate)
+acq_duration = nscans / float(rate)
+
+# Min/max envelope from the overview pyramid (sidecar file, built on
+# first use): about 2 points per pixel whatever the file length, with
+# every peak kept
+plot_width = int(12 * plt.rcParams['figure.dpi'])
+pyramid = overview_for(rec)
+t, lo, hi = pyramid.envelope(t_start, t_start + acq_duration, plot_width,
+                             rec)
+t = np.repeat(t, 2)
+envelope = np.empty((len(t), rec.nchan), dtype=np.float32)
+envelope[0::2] = to_volts(lo)
+envelope[1::2] = to_volts(hi)
 
 plt.figure(1,figsize=(12,7))
 
-plt.plot(t,chan_1_float,color='blue',linewidth='1',label='chan_1')
-plt.plot(t,chan_2_float,color='red',linewidth='1',label='chan_2')
-plt.plot(t,chan_3_float,color='green',linewidth='1',label='chan_3')
+plt.plot(t,envelope[:,0],color='blue',linewidth='1',label='chan_1')
+plt.plot(t,envelope[:,1],color='red',linewidth='1',label='chan_2')
+plt.plot(t,envelope[:,2],color='green',linewidth='1',label='chan_3')
+if segments is not None:
+    for a, b in segments[:1000]:
+        plt.axvspan(a / float(rate), b / float(rate), color='0.85')
 plt.xlabel('Time[s]')
 plt.ylabel('Amplitude[V]')
 plt.legend(loc='upper right')
@@ -127,17 +262,14 @@ plt.show()
 #
 # Spectrum
 #
-def spectrum(y):
-    nfft=int(4*(2**(np.ceil(np.log2(len(y))))))
-    Y=fft(y,nfft)
-    F=fftfreq(nfft,1/rate)
-    F=F[0:nfft//2]
-    Y=20*np.log10(abs(Y[0:nfft//2]))
-    return Y, F
-
-YY1,F1=spectrum(chan_1_float)
-YY2,F2=spectrum(chan_2_float)
-YY3,F3=spectrum(chan_3_float)
+# One batched real FFT for all channels (dB magnitudes, Nyquist dropped)
+result = cached('spectrum',
+                lambda: dict(zip(('Y', 'F'),
+                                 spectrum(volts,rate,zeropad,padding,workers))),
+                zeropad=zeropad, padding=padding)
+YY,F=result['Y'],result['F']
+YY1,YY2,YY3=YY[:,0],YY[:,1],YY[:,2]
+F1=F2=F3=F
 
 plt.figure(2,figsize=(12,7))
 plt.suptitle('Spectrum Graph',size='xx-large')
@@ -159,28 +291,132 @@ plt.show()
 #
 #****************************************************************************#
 #
+# Zoom spectrum: chirp-z over the requested band only, chunk by chunk
+#
+if zoom_band is not None:
+    fmin, fmax, nbins = zoom_band
+    result = cached('zoom',
+                    lambda: dict(zip(('Y', 'F'),
+                                     zoom(rate, fmin, fmax,
+                                          int(nbins)).run(rec,
+                                                          start=first,
+                                                          stop=last))),
+                    fmin=fmin, fmax=fmax, nbins=int(nbins))
+    YZ,FZ = result['Y'],result['F']
+
+    plt.figure(3,figsize=(12,7))
+    plt.suptitle('Zoom Spectrum {:g}-{:g} Hz'.format(fmin, fmax),
+                 size='xx-large')
+    for n, color in enumerate(['blue', 'red', 'green']):
+        plt.subplot(3,1,n+1)
+        plt.plot(FZ,YZ[:,n],color=color)
+        plt.grid()
+    plt.xlabel('Frequency [Hz]')
+
+    plt.show()
+#
+#****************************************************************************#
+#
+# Welch PSD: averaged segment power, accumulated chunk by chunk with the
+# frame / overlap / window settings; with --output the accumulator is
+# saved so PSDs of several files can be merged later.  With -d it is
+# averaged over the DI high segments only (one accumulator per segment,
+# merged, so no frame spans two segments)
+#
+if (psd == 1):
+    psd_frame = min(frame, nscans)
+
+    def accumulator():
+        return welch(rate, rec.nchan, window=window_type, nperseg=psd_frame,
+                     noverlap=int((overlap/100)*psd_frame),
+                     nfft=max(NFFT, psd_frame))
+    acc = accumulator()
+
+    def accumulate():
+        parts = [(first, last)] if segments is None else segments
+        for a, b in parts:
+            part = accumulator()
+            for n, block in rec.chunks(start=a, stop=b):
+                part.feed(block)
+            acc.merge(part)
+        return {'power': acc.power, 'segments': acc.segments}
+
+    result = cached('psd', accumulate, frame=psd_frame, overlap=overlap,
+                    nfft=acc.nfft, window=window_type, digital=digital_bit)
+    acc.power, acc.segments = result['power'], int(result['segments'])
+    Pxx,FP = acc.result()
+    print('Welch PSD: {} segments'.format(acc.segments))
+    print('Noise floor (median) [V/sqrt(Hz)]:',
+          np.sqrt(np.median(Pxx, axis=0)))
+    if (output_dir != ''):
+        base = output_base
+        acc.save(os.path.join(output_dir, base + '_psd.npz'))
+
+    plt.figure(4,figsize=(12,7))
+    plt.suptitle('Welch PSD',size='xx-large')
+    for n, color in enumerate(['blue', 'red', 'green']):
+        plt.subplot(3,1,n+1)
+        plt.plot(FP,10*np.log10(Pxx[:,n]),color=color)
+        plt.ylabel('dB V**2/Hz')
+        plt.grid()
+    plt.xlabel('Frequency [Hz]')
+
+    plt.show()
+#
+#****************************************************************************#
+#
 # Spectrogram
 #
-if frame > len(chan_1_float):
-    frame = len(chan_1_float)
+if frame > nscans:
+    frame = nscans
     print('Frame length was longer than the data.')
     print('Thus, the new frame length is equal to the length of the data.')
-    
-def spectrogram(data,channel_name):
-    #channel_descrp = [ k for k,v in locals().iteritems() if v == data][0]
-    frame_overlap = int((overlap/100)*frame)
-    freqs, times, Sx = signal.spectrogram(data,
-                                      fs=rate,
-                                      window=window_type,
-                                      nperseg=frame,
-                                      noverlap=frame_overlap,
-                                      nfft=NFFT,
-                                      detrend=False,
-                                      return_onesided=True,
-                                      mode='magnitude',
-                                      scaling='spectrum')
+
+#
+# All channels in one streaming pass over the file; with --output the
+# columns go straight to disk as they are computed, and are plotted from
+# the memory-mapped result
+#
+frame_overlap = int((overlap/100)*frame)
+NFFT = max(NFFT, frame)
+engine = stft(rate, rec.nchan, window=window_type, nperseg=frame,
+              noverlap=frame_overlap, nfft=NFFT, db=True)
+if cache is not None:
+    key = cache.key(digest, 'spectrogram', first=first, last=last,
+                    frame=frame,
+                    overlap=frame_overlap, nfft=NFFT, window=window_type)
+    Sx_all = cache.load_array(key)
+    if Sx_all is None:
+        engine.output = spectrogram_writer(cache.new_array(key), rec.nchan,
+                                           engine.nfreq)
+        engine.run(rec, start=first, stop=last)
+        Sx_all = cache.finish_array(key)
+    if (output_dir != ''):
+        base = output_base
+        spectrogram_file = os.path.join(output_dir,
+                                        base + '_spectrogram.npy')
+        shutil.copyfile(Sx_all.filename, spectrogram_file)
+        print('Spectrogram written to', spectrogram_file)
+elif (output_dir != ''):
+    base = output_base
+    spectrogram_file = os.path.join(output_dir, base + '_spectrogram.npy')
+    engine.output = spectrogram_writer(spectrogram_file, rec.nchan,
+                                       engine.nfreq)
+    engine.run(rec, start=first, stop=last)
+    Sx_all = np.load(spectrogram_file, mmap_mode='r')
+    print('Spectrogram written to', spectrogram_file)
+else:
+    Sx_all = np.concatenate([engine.feed(block)[1]
+                             for n, block in rec.chunks(start=first,
+                                                        stop=last)])
+freqs = engine.frequencies
+times = t_start + engine.time(np.arange(len(Sx_all)))
+
+def spectrogram(position,channel_name):
+    # (time, frequency) columns of one channel, already in dB
+    Sx = Sx_all[:, position, :].T
     f, ax = plt.subplots(figsize=(12, 7))
-    ax.pcolormesh(times,freqs / 1000,10*np.log10(Sx),cmap=cmap)
+    ax.pcolormesh(times,freqs / 1000,Sx,cmap=cmap)
     annotation = '"{}" @ {} s/sec ({} s/frame @ {} overlap + {}, fft @ {})'.format(channel_name,
                                                                                rate,
                                                                                frame,
@@ -193,8 +429,8 @@ def spectrogram(data,channel_name):
     plt.show()
 
 # Plotting spectrograms for our data from three channels
-spectrogram(chan_1_float,'Channel 1')
-spectrogram(chan_2_float,'Channel 2')
-spectrogram(chan_3_float,'Channel 3')
+spectrogram(0,'Channel 1')
+spectrogram(1,'Channel 2')
+spectrogram(2,'Channel 3')
 
 sys.exit()
@@ -27,6 +27,7 @@ import array as arr
 
 # Is there a better way to do this?
 from dataq_utilities.serial_commands import dataq
+from dataq_utilities.decoder import decoder
 DataQ = dataq()
 
 print('Using Python: {:1d}.{:1d}'
@@ -105,29 +106,30 @@ print('')
 nsamp_acq = 0
 scale_factor = 10 / 32768
 
-samples = arr.array('i')
+blocks = []
 waiting = arr.array('I')
+decode = decoder(len(slist))
 
 DataQ.send_command(ser, 'start', True)
 start = time.time()
 
 while (nsamp_acq < Max_Samples):
-    while (ser.inWaiting() > 2):
-        # how many bytes waiting on link?
-        waiting.append(ser.inWaiting())
+    # how many bytes waiting on link?
+    nwait = ser.inWaiting()
+    if (nwait >= 2):
+        waiting.append(nwait)
 
-        # read next sample & append to array
-        result = int.from_bytes(ser.read(2),
-                                byteorder='little',
-                                signed=True)
-
-        samples.append(result)
+        # decode everything waiting & append the whole scans
+        block = decode.decode(ser.read(nwait))
+        blocks.append(block[:, 0].copy())
 
         # give per-second indicator
-        if (nsamp_acq % Fs == 0):
-            print('sample: {}'.format(nsamp_acq))
+        if ((nsamp_acq + len(block)) // Fs > nsamp_acq // Fs):
+            print('sample: {}'.format(nsamp_acq + len(block)))
+
+        nsamp_acq = nsamp_acq + len(block)
 
-        nsamp_acq = nsamp_acq+1
+samples = np.concatenate(blocks)
 
 #
 # Shut down the device
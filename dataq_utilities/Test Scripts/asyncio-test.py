@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Exercises the asyncio transport (dataq_utilities/aio.py).
+#
+# By default it drives several DI-1100 emulators on pseudo-terminals from
+# one event loop and checks every decoded scan against what the emulator
+# sent.  With -p it uses real devices instead (comma separated ports, or
+# "discover").
+#
+# Inputs:
+#   c: analog channels (0,1,2,3)
+#   r: sampling rate (samples/sec)
+#   t: time duration / length (sec)
+#   N: number of emulated devices
+#   p: port(s) of real devices
+#
+
+import argparse
+import asyncio
+import sys
+import numpy as np
+
+from dataq_utilities.aio import async_dataq
+from dataq_utilities.emulator import emulator
+
+print('Using Python: {:1d}.{:1d}'
+      .format(sys.version_info[0], sys.version_info[1]))
+
+#
+# Parse Command Line Arguments
+#
+parser = argparse.ArgumentParser(description='asyncio DataQ test')
+parser.add_argument('-c', '--channel', default=[0,1,2], type=int, nargs='+',
+                    help='Channel [0,1,2,3]', required=False)
+parser.add_argument('-r', '--rate', default=10000, type=int,
+                    help='Sampling Rate (sps)', required=False)
+parser.add_argument('-t', '--time', default=1, type=float,
+                    help='Length (sec)', required=False)
+parser.add_argument('-N', '--ndev', default=2, type=int,
+                    help='Number of emulated devices', required=False)
+parser.add_argument('-p', '--port', default='', type=str,
+                    help='Real device port(s) or "discover"', required=False)
+
+args = parser.parse_args()
+channel = args.channel
+desired_rate = args.rate
+acq_duration = args.time
+
+if (args.port == ''):
+    fakes = [emulator(slist=channel) for n in range(args.ndev)]
+    ports = [fake.start() for fake in fakes]
+elif (args.port == 'discover'):
+    fakes = []
+    ports = async_dataq.discover()
+else:
+    fakes = []
+    ports = args.port.split(',')
+
+#
+# One device: configure, stream, check
+#
+async def run_device(port):
+    async with async_dataq(port) as dev:
+        Fs = await dev.configure(channel, desired_rate)
+        Max_Samples = int(Fs * acq_duration)
+        received = []
+        await dev.start()
+        async for block in dev.blocks(Max_Samples):
+            received.append(block)
+        await dev.stop()
+        samples = np.concatenate(received)
+        setup = sum(rtt for command, rtt in dev.timings[:-1])
+        return port, Fs, samples, setup, dev.overruns
+
+#
+# All devices on one event loop, plus a heartbeat task to show the loop
+# is never blocked
+#
+async def main():
+    beats = 0
+
+    async def heartbeat():
+        nonlocal beats
+        while True:
+            await asyncio.sleep(0.01)
+            beats += 1
+
+    beat = asyncio.create_task(heartbeat())
+    results = await asyncio.gather(*[run_device(p) for p in ports])
+    beat.cancel()
+    return results, beats
+
+results, beats = asyncio.run(main())
+
+failed = 0
+for n, (port, Fs, samples, setup, overruns) in enumerate(results):
+    print('{}: {} scans at {} Hz, setup {:.3f} s, overruns {}'
+          .format(port, len(samples), Fs, setup, overruns))
+    if fakes:
+        expected = fakes[n].scan_values(0, len(samples))
+        bad = int(np.any(samples != expected, axis=1).sum())
+        print('\t mismatched scans: {}'.format(bad))
+        failed += bad
+print('Event loop heartbeats: {} (expected about {})'
+      .format(beats, int(acq_duration / 0.01)))
+
+for fake in fakes:
+    fake.close()
+
+sys.exit(1 if failed else 0)
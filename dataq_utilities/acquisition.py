@@ -0,0 +1,35 @@
+#
+# Reads of DataQ binary streams.
+#
+# Reads land directly in memoryview slices of a caller's buffer (the
+# pipeline's pooled blocks, see pipeline.py), so no intermediate bytes
+# objects are made.
+#
+
+import os
+import select
+
+#
+# Read from the serial port straight into a writable buffer
+#
+# On POSIX the bytes go from the port's file descriptor into the buffer
+# with readv(); elsewhere pyserial's readinto() is used.  With a timeout
+# the call waits up to that long for data to arrive (pyserial's own
+# ser.timeout applies on the fallback path).
+#
+# Returns the number of bytes read
+#
+
+def readinto(ser, view, timeout=None):
+    fd = getattr(ser, 'fd', None)
+    if fd is not None and hasattr(os, 'readv'):
+        if timeout is not None:
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if not ready:
+                return 0
+        try:
+            return os.readv(fd, [view])
+        except BlockingIOError:
+            return 0
+    return ser.readinto(view)
+
@@ -0,0 +1,240 @@
+#
+# asyncio transport for DataQ devices.
+#
+# async_dataq offers the same operations as the dataq class (discover,
+# send command, configure the scan list, set the sampling rate,
+# start/stop) without blocking calls or sleeps.  The serial port is
+# opened non-blocking and registered with the event loop (add_reader),
+# so one loop can drive several devices plus network I/O without
+# threads.  While scanning, incoming bytes go through the binary decoder
+# and decoded (n, nchan) int16 blocks are available from the async
+# iterator returned by blocks().
+#
+# add_reader() needs a selector event loop and a real file descriptor,
+# so this works on POSIX systems only.
+#
+
+import asyncio
+import os
+import time
+import serial
+
+from dataq_utilities.serial_commands import dataq
+from dataq_utilities.decoder import decoder
+
+class async_dataq:
+    def __init__(self, port=None, baudrate='1382400', queue_blocks=256,
+                 verbose=False):
+        ''' Constructor for this class '''
+        self.port = port
+        self.baudrate = baudrate
+        self.verbose = verbose
+        self.ser = None
+        self.loop = None
+        self.queue_blocks = queue_blocks
+
+        self.slist = []
+        self.Fs = None
+        self.scanning = False
+        self.decoder = None
+        self.queue = None
+        self.text = bytearray()
+        self.waiter = None
+        self.timings = []
+
+        self.overruns = 0
+        self.scans = 0
+
+    #
+    # All DATAQ Instruments ports on this machine
+    #
+    # Returns a list of port names
+    #
+
+    @staticmethod
+    def discover():
+        return dataq().discover_devices()
+
+    #
+    # Open the port and register it with the running event loop
+    #
+
+    async def open(self, port=None):
+        if port is not None:
+            self.port = port
+        if self.port is None:
+            ports = async_dataq.discover()
+            if not ports:
+                raise RuntimeError('No DataQ devices found')
+            self.port = ports[0]
+        self.loop = asyncio.get_running_loop()
+        self.ser = serial.Serial()
+        self.ser.port = self.port
+        self.ser.baudrate = self.baudrate
+        self.ser.timeout = 0
+        self.ser.open()
+        self.loop.add_reader(self.ser.fd, self.readable)
+        return self
+
+    async def close(self):
+        if self.ser is None:
+            return
+        if self.scanning:
+            await self.stop()
+        self.loop.remove_reader(self.ser.fd)
+        self.ser.close()
+        self.ser = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    #
+    # Event loop callback: the port has data
+    #
+
+    def readable(self):
+        try:
+            data = os.read(self.ser.fd, 65536)
+        except BlockingIOError:
+            return
+        if not data:
+            return
+        if self.scanning:
+            samples = self.decoder.decode(data)
+            if len(samples):
+                self.scans += len(samples)
+                try:
+                    self.queue.put_nowait(samples.copy())
+                except asyncio.QueueFull:
+                    # Nobody is consuming: drop the oldest block
+                    self.overruns += 1
+                    self.queue.get_nowait()
+                    self.queue.put_nowait(samples.copy())
+            return
+        self.text += data
+        self.check_echo()
+
+    def check_echo(self):
+        if self.waiter is None or self.waiter[1].done():
+            return
+        word, future = self.waiter
+        while True:
+            end = self.text.find(b'\r')
+            if end < 0:
+                return
+            line = bytes(self.text[:end])
+            del self.text[:end + 1]
+            start = line.rfind(word)
+            if start >= 0:
+                s = line[start:].decode(errors='ignore')
+                future.set_result(s.strip('\n').strip(chr(0)))
+                return
+
+    #
+    # Send a command and wait for its echo
+    #
+    # Returns the echo string (None when acquiring)
+    #
+
+    async def send_command(self, command, acquiring=False, timeout=1.0):
+        t0 = time.perf_counter()
+        if not acquiring:
+            self.text = bytearray()
+            future = self.loop.create_future()
+            self.waiter = (command.split()[0].encode(), future)
+        self.ser.write((command + '\r').encode())
+        if acquiring:
+            return None
+        try:
+            s = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            s = None
+        finally:
+            self.waiter = None
+        rtt = time.perf_counter() - t0
+        self.timings.append((command, rtt))
+        if self.verbose:
+            print('Cmd / Echo: {} / {}'.format(command, s))
+        if s is None:
+            raise RuntimeError('{}: no echo for {}'.format(self.port,
+                                                           command))
+        return s
+
+    async def config_scan_list(self, slist):
+        self.slist = list(slist)
+        for position, item in enumerate(self.slist):
+            await self.send_command('slist {} {}'.format(position, item))
+
+    #
+    # Returns actual sampling rate
+    #
+
+    async def sampling_rate(self, desired_rate, decimation_factor=1):
+        srate_value = int(60000000 / desired_rate / decimation_factor)
+        await self.send_command('srate {}'.format(srate_value))
+        return int(60000000 / srate_value / decimation_factor)
+
+    #
+    # The Data_acq.py setup sequence
+    #
+    # Returns actual sampling rate
+    #
+
+    async def configure(self, slist, desired_rate, decimation_factor=1,
+                        filter_mode=0, dec=1, deca=1, packet_size=0):
+        await self.send_command('stop')
+        await self.send_command('encode 0')
+        await self.send_command('ps {}'.format(packet_size))
+        await self.send_command('dec {}'.format(dec))
+        await self.send_command('deca {}'.format(deca))
+        for item in sorted(set(slist)):
+            await self.send_command('filter {} {}'.format(item, filter_mode))
+        await self.config_scan_list(slist)
+        self.Fs = await self.sampling_rate(desired_rate, decimation_factor)
+        return self.Fs
+
+    async def start(self):
+        self.decoder = decoder(len(self.slist))
+        self.queue = asyncio.Queue(maxsize=self.queue_blocks)
+        self.scans = 0
+        self.scanning = True
+        await self.send_command('start', True)
+
+    async def stop(self):
+        self.scanning = False
+        s = await self.send_command('stop')
+        if self.queue is not None:
+            # Wake up a consumer waiting in blocks()
+            try:
+                self.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+        return s
+
+    #
+    # Async iterator of decoded (n, nchan) int16 blocks
+    #
+    # Ends after max_scans scans (the last block is trimmed) or when the
+    # device is stopped.  Raises RuntimeError if no data arrives for
+    # timeout seconds (e.g. the device stopped itself on a buffer overflow)
+    #
+
+    async def blocks(self, max_scans=None, timeout=1.0):
+        delivered = 0
+        while max_scans is None or delivered < max_scans:
+            if not self.scanning and self.queue.empty():
+                return
+            try:
+                samples = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                raise RuntimeError('{}: no data for {} s'
+                                   .format(self.port, timeout))
+            if samples is None:
+                return
+            if max_scans is not None:
+                samples = samples[:max_scans - delivered]
+            delivered += len(samples)
+            yield samples
@@ -0,0 +1,172 @@
+#
+# Headless batch processing of recordings.
+#
+# Every file of a directory (or glob; .wav or .dqz) is processed in its
+# own worker process, so a night's recordings use all cores.  For each
+# file the worker writes, into the output directory:
+#
+#     <name>_spectrum.npz      F, Y (dB, see spectrum.py), for files of
+#                              at most max_spectrum_scans scans
+#     <name>_spectrogram.npy   (time, channel, frequency) dB columns
+#     <name>_psd.npz           Welch accumulator (mergeable, see welch)
+#
+# and returns a summary (filename metadata, per-channel statistics, the
+# spectral peak and PSD noise floor of every channel, output paths).  The
+# summaries of all files are written to index.json in the same directory.
+#
+# The analysis settings are those of Processing.py: frame, overlap (pct
+# of frame), zeropad, window and spectrum padding.
+#
+# Everything but the whole-file spectrum is computed chunk by chunk, so
+# a worker's memory does not grow with the file.  The spectrum needs the
+# whole file in memory, so longer files get none and their spectral peak
+# is taken from the PSD instead.
+#
+# Workers are forked where the platform allows it: Processing.py is a
+# plain script, and spawned workers would re-run it on import.
+#
+
+import glob
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dataq_utilities.compressed import open_recording
+from dataq_utilities.spectrum import spectrum, welch
+from dataq_utilities.stft import stft, spectrogram_writer
+from dataq_utilities.wav_writer import parse_wav_filename
+
+#
+# Recordings named by a directory, a glob or a file
+#
+# Returns a sorted list of filenames
+#
+
+def find_recordings(pattern):
+    if os.path.isdir(pattern):
+        return sorted(glob.glob(os.path.join(pattern, '*.wav')) +
+                      glob.glob(os.path.join(pattern, '*.dqz')))
+    return sorted(glob.glob(pattern))
+
+#
+# FFT length of the spectrogram / PSD frames (as in Processing.py)
+#
+
+def frame_nfft(frame, zeropad):
+    if (zeropad == 0):
+        return frame
+    return max(2 ** int(np.ceil(np.log2(np.abs(frame*zeropad)))), frame)
+
+#
+# Process one recording
+#
+# Returns a summary dictionary
+#
+
+def process_file(filename, output_dir, frame=1024, overlap=25, zeropad=4,
+                 window='hann', padding='pow2', chunk_scans=65536,
+                 workers=1, max_spectrum_scans=2**22):
+    t0 = time.perf_counter()
+    base = os.path.splitext(os.path.basename(filename))[0]
+    out = os.path.join(output_dir, base)
+    rec = open_recording(filename)
+    summary = {'file': os.path.abspath(filename),
+               'metadata': parse_wav_filename(filename),
+               'rate': rec.rate,
+               'nchan': rec.nchan,
+               'nscans': rec.nscans,
+               'duration': rec.duration}
+    if summary['metadata'] is not None:
+        summary['metadata']['when'] = summary['metadata']['when'].isoformat()
+
+    frame = min(frame, rec.nscans)
+    noverlap = int((min(overlap, 75)/100)*frame)
+    NFFT = frame_nfft(frame, zeropad)
+
+    # One pass over the file: statistics, spectrogram and PSD together
+    total = np.zeros(rec.nchan)
+    squares = np.zeros(rec.nchan)
+    low = np.full(rec.nchan, np.inf)
+    high = np.full(rec.nchan, -np.inf)
+    volts = None
+    if rec.nscans <= max_spectrum_scans:
+        volts = np.empty((rec.nscans, rec.nchan), dtype=np.float32)
+    engine = stft(rec.rate, rec.nchan, window=window, nperseg=frame,
+                  noverlap=noverlap, nfft=NFFT, db=True, workers=workers,
+                  output=spectrogram_writer(out + '_spectrogram.npy',
+                                            rec.nchan,
+                                            NFFT // 2 + 1))
+    acc = welch(rec.rate, rec.nchan, window=window, nperseg=frame,
+                noverlap=noverlap, nfft=NFFT, workers=workers)
+    for first, block in rec.chunks(chunk_scans):
+        if volts is not None:
+            volts[first:first + len(block)] = block
+        total += block.sum(axis=0, dtype=np.float64)
+        squares += np.square(block, dtype=np.float64).sum(axis=0)
+        low = np.minimum(low, block.min(axis=0))
+        high = np.maximum(high, block.max(axis=0))
+        engine.feed(block)
+        acc.feed(block)
+    engine.close()
+    acc.save(out + '_psd.npz')
+
+    Pxx, FP = acc.result()
+    outputs = {'spectrogram': out + '_spectrogram.npy',
+               'psd': out + '_psd.npz'}
+    if volts is not None:
+        Y, F = spectrum(volts, rec.rate, zeropad, padding, workers)
+        del volts
+        np.savez(out + '_spectrum.npz', F=F, Y=Y)
+        outputs['spectrum'] = out + '_spectrum.npz'
+    else:
+        Y, F = Pxx, FP
+
+    n = max(rec.nscans, 1)
+    summary.update({'mean': (total / n).tolist(),
+                    'rms': np.sqrt(squares / n).tolist(),
+                    'min': low.tolist(),
+                    'max': high.tolist(),
+                    # Strongest line above DC, per channel
+                    'peak_hz': F[1 + np.argmax(Y[1:], axis=0)].tolist(),
+                    'noise_floor': np.sqrt(np.median(Pxx, axis=0)).tolist(),
+                    'outputs': outputs,
+                    'elapsed': time.perf_counter() - t0})
+    return summary
+
+#
+# Process all recordings matching pattern in parallel
+#
+# Returns the list of summaries (in filename order), also written to
+# output_dir/index.json
+#
+
+def run_batch(pattern, output_dir, processes=None, verbose=True, **params):
+    files = find_recordings(pattern)
+    os.makedirs(output_dir, exist_ok=True)
+    summaries = {}
+    context = None
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=processes,
+                             mp_context=context) as pool:
+        jobs = {pool.submit(process_file, f, output_dir, **params): f
+                for f in files}
+        for job in as_completed(jobs):
+            filename = jobs[job]
+            try:
+                summaries[filename] = job.result()
+            except Exception as err:
+                summaries[filename] = {'file': os.path.abspath(filename),
+                                       'error': str(err)}
+            if verbose:
+                print('{}: {}'.format(filename,
+                                      summaries[filename].get('error',
+                                                              'done')))
+    index = [summaries[f] for f in files]
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+        f.write('\n')
+    return index
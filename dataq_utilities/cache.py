@@ -0,0 +1,184 @@
+#
+# On-disk cache of analysis results.
+#
+# Entries are keyed by a content hash of the recording plus the name of
+# the analysis stage and only the parameters that stage depends on, e.g.
+#
+#     spectrum:    zeropad, padding
+#     spectrogram: frame, overlap, nfft, window
+#
+# so changing one setting only recomputes the stages that use it.  Small
+# results are stored as .npz files (store / load); large ones, such as
+# spectrograms, as .npy files that are written in place by a streaming
+# writer (new_array / finish_array) and memory-mapped on load.
+#
+# Least recently used entries are deleted when the cache grows past
+# max_bytes; a hit refreshes the entry's modification time.
+#
+# The content hash covers the file size, the header and 64 evenly spaced
+# 64 kB blocks of the file (all of it for small files), so hashing a
+# multi-GB recording reads 4 MB.  Hashes are remembered per (path, size,
+# mtime) in the cache directory.
+#
+
+import hashlib
+import json
+import os
+import numpy as np
+
+SAMPLE_BLOCKS = 64
+BLOCK_BYTES = 65536
+
+#
+# Fast content hash of a file
+#
+# Returns a hex string
+#
+
+def content_hash(filename):
+    size = os.path.getsize(filename)
+    h = hashlib.blake2b(str(size).encode(), digest_size=20)
+    with open(filename, 'rb') as f:
+        if size <= SAMPLE_BLOCKS * BLOCK_BYTES:
+            h.update(f.read())
+        else:
+            step = (size - BLOCK_BYTES) // (SAMPLE_BLOCKS - 1)
+            for n in range(SAMPLE_BLOCKS):
+                f.seek(n * step)
+                h.update(f.read(BLOCK_BYTES))
+    return h.hexdigest()
+
+
+class result_cache:
+    def __init__(self, directory, max_bytes=2**30):
+        ''' Constructor for this class '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    #
+    # Content hash of a recording, remembered by path, size and mtime
+    #
+
+    def file_hash(self, filename):
+        st = os.stat(filename)
+        stamp = '{}:{}:{}'.format(os.path.realpath(filename), st.st_size,
+                                  st.st_mtime_ns)
+        hashes = os.path.join(self.directory, 'hashes.json')
+        try:
+            with open(hashes) as f:
+                known = json.load(f)
+        except (OSError, ValueError):
+            known = {}
+        if stamp not in known:
+            if len(known) >= 10000:
+                # Forget the oldest half
+                known = dict(list(known.items())[5000:])
+            known[stamp] = content_hash(filename)
+            tmp = hashes + '.part'
+            with open(tmp, 'w') as f:
+                json.dump(known, f)
+            os.replace(tmp, hashes)
+        return known[stamp]
+
+    #
+    # Cache key for one stage of one recording
+    #
+    # Returns a hex string
+    #
+
+    def key(self, digest, stage, **params):
+        text = json.dumps([digest, stage, sorted(params.items())])
+        return stage + '-' + hashlib.blake2b(text.encode(),
+                                             digest_size=16).hexdigest()
+
+    def path(self, key, ext):
+        return os.path.join(self.directory, key + ext)
+
+    def touch(self, filename):
+        try:
+            os.utime(filename)
+            return True
+        except OSError:
+            return False
+
+    #
+    # Small results: a dictionary of arrays in one .npz file
+    #
+    # load() returns the dictionary, or None on a miss
+    #
+
+    def load(self, key):
+        filename = self.path(key, '.npz')
+        if not self.touch(filename):
+            self.misses += 1
+            return None
+        self.hits += 1
+        with np.load(filename) as f:
+            return {name: f[name] for name in f.files}
+
+    def store(self, key, **arrays):
+        filename = self.path(key, '.npz')
+        tmp = filename + '.part'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, filename)
+        self.evict(keep=filename)
+
+    #
+    # Large results: one .npy file, written by the caller to new_array()
+    # and published by finish_array()
+    #
+    # load_array() returns a read-only memory map, or None on a miss;
+    # finish_array() returns one of the result just written (which is
+    # not evicted, even if it alone is larger than max_bytes)
+    #
+
+    def load_array(self, key):
+        filename = self.path(key, '.npy')
+        if not self.touch(filename):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.load(filename, mmap_mode='r')
+
+    def new_array(self, key):
+        return self.path(key, '.npy.part')
+
+    def finish_array(self, key):
+        filename = self.path(key, '.npy')
+        os.replace(self.path(key, '.npy.part'), filename)
+        self.evict(keep=filename)
+        return np.load(filename, mmap_mode='r')
+
+    #
+    # Delete least recently used entries until the cache fits max_bytes,
+    # except keep (the entry just written)
+    #
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(('.npz', '.npy')):
+                continue
+            filename = os.path.join(self.directory, name)
+            if filename == keep:
+                continue
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+        total = sum(size for mtime, size, filename in entries)
+        if keep is not None and os.path.exists(keep):
+            total += os.path.getsize(keep)
+        for mtime, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
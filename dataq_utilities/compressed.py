@@ -0,0 +1,319 @@
+#
+# Compressed, block-indexed recording format (.dqz).
+#
+# Scans are stored in fixed-size blocks of block_scans int16 scans.  Each
+# block is delta-coded along time per channel (wrapping int16
+# differences), byte-shuffled (all low bytes, then all high bytes, so the
+# near-constant high bytes of small differences sit together) and
+# compressed with zlib.  Quiet signals shrink several-fold; the samples
+# come back bit for bit.
+#
+# Layout (little-endian):
+#
+#     header   'DQZ1', rate (u32), nchan (u16), block_scans (u32),
+#              codec (u8, 1 = zlib), filter (u8, 1 = delta + shuffle)
+#     blocks   block record (block_dtype) + compressed payload
+#     index    one index record (index_dtype) per block
+#     trailer  index offset (u64), number of blocks (u64), 'DQZI'
+#
+# Every block record carries the block's first scan, size and per-channel
+# min / max / mean, so the index maps a sample offset to a byte offset
+# and summarises any range without decompressing it.  A file that is
+# still being written (.part, no index yet) is read by walking the block
+# records.
+#
+# compressed_writer is a wav_writer (same naming, rollover, overview
+# and edge index options) and so a pipeline sink; compressed_recording
+# has the reader API of recording.  open_recording() opens either format.
+#
+
+import os
+import struct
+import zlib
+import numpy as np
+
+from dataq_utilities.recording import recording
+from dataq_utilities.wav_writer import wav_writer
+
+MAGIC = b'DQZ1'
+INDEX_MAGIC = b'DQZI'
+HEADER = struct.Struct('<4sIHIBB')
+TRAILER = struct.Struct('<QQ4s')
+CODEC_ZLIB = 1
+FILTER_DELTA_SHUFFLE = 1
+
+#
+# Block record and index record dtypes for nchan channels
+#
+
+def block_dtype(nchan):
+    return np.dtype([('first', '<u8'), ('nscans', '<u4'), ('nbytes', '<u4'),
+                     ('min', '<i2', (nchan,)), ('max', '<i2', (nchan,)),
+                     ('mean', '<f4', (nchan,))])
+
+def index_dtype(nchan):
+    return np.dtype([('offset', '<u8')] + block_dtype(nchan).descr)
+
+#
+# Encode an (n, nchan) int16 block
+#
+# Returns bytes
+#
+
+def encode(block, level=1):
+    x = np.asarray(block, dtype='<i2')
+    d = x.copy()
+    d[1:] -= x[:-1]
+    # Channel-major, then low bytes before high bytes
+    planes = np.ascontiguousarray(d.T).view(np.uint8).reshape(-1, 2).T
+    return zlib.compress(planes.tobytes(), level)
+
+#
+# Decode a block of nscans scans
+#
+# Returns an (nscans, nchan) int16 array
+#
+
+def decode(payload, nscans, nchan):
+    planes = np.frombuffer(zlib.decompress(payload), np.uint8)
+    d = planes.reshape(2, -1).T.copy().view('<i2').reshape(nchan, nscans).T
+    return np.cumsum(d, axis=0, dtype=np.int16)
+
+
+class compressed_writer(wav_writer):
+    EXTENSION = '.dqz'
+
+    def __init__(self, rate, channel, directory='.', max_bytes=None,
+                 max_seconds=None, overview=False, edges=False,
+                 block_scans=8192, level=1):
+        ''' Constructor for this class '''
+        wav_writer.__init__(self, rate, channel, directory, max_bytes,
+                            max_seconds, overview, edges)
+        self.block_scans = block_scans
+        self.level = level
+        self.block = block_dtype(self.nchan)
+
+    def start_file(self):
+        self.f.write(HEADER.pack(MAGIC, self.rate, self.nchan,
+                                 self.block_scans, CODEC_ZLIB,
+                                 FILTER_DELTA_SHUFFLE))
+        self.pending = np.zeros((0, self.nchan), np.int16)
+        self.index = []
+
+    #
+    # Frames are buffered until a block is full
+    #
+
+    def append(self, samples):
+        x = np.concatenate((self.pending, samples))
+        n = len(x) // self.block_scans * self.block_scans
+        for first in range(0, n, self.block_scans):
+            self.store(x[first:first + self.block_scans])
+        self.pending = x[n:].copy()
+
+    def store(self, block):
+        payload = encode(block, self.level)
+        record = np.zeros(1, self.block)
+        record['first'] = self.stored_scans()
+        record['nscans'] = len(block)
+        record['nbytes'] = len(payload)
+        record['min'] = block.min(axis=0)
+        record['max'] = block.max(axis=0)
+        record['mean'] = block.mean(axis=0, dtype=np.float64)
+        self.index.append((self.f.tell(), record))
+        self.f.write(record.tobytes())
+        self.f.write(payload)
+
+    def stored_scans(self):
+        if not self.index:
+            return 0
+        last = self.index[-1][1]
+        return int(last['first'][0]) + int(last['nscans'][0])
+
+    #
+    # Last (partial) block, then the index and trailer
+    #
+
+    def end_file(self):
+        if len(self.pending):
+            self.store(self.pending)
+            self.pending = self.pending[:0]
+        index = np.zeros(len(self.index), index_dtype(self.nchan))
+        for n, (offset, record) in enumerate(self.index):
+            index[n]['offset'] = offset
+            for name in self.block.names:
+                index[n][name] = record[name][0]
+        start = self.f.tell()
+        self.f.write(index.tobytes())
+        self.f.write(TRAILER.pack(start, len(index), INDEX_MAGIC))
+
+
+class compressed_recording:
+    def __init__(self, filename):
+        ''' Constructor for this class '''
+        self.filename = filename
+        self.f = open(filename, 'rb')
+        head = self.f.read(HEADER.size)
+        if len(head) < HEADER.size or head[:4] != MAGIC:
+            raise ValueError('{}: not a .dqz file'.format(filename))
+        (magic, self.rate, self.nchan, self.block_scans, codec,
+         self.filter) = HEADER.unpack(head)
+        if codec != CODEC_ZLIB or self.filter != FILTER_DELTA_SHUFFLE:
+            raise ValueError('{}: unknown codec {} / filter {}'
+                             .format(filename, codec, self.filter))
+        self.frame_bytes = 2 * self.nchan
+        self.index = self.read_index()
+        if len(self.index):
+            self.nscans = int(self.index['first'][-1] +
+                              self.index['nscans'][-1])
+        else:
+            self.nscans = 0
+        self.starts = self.index['first'].astype(np.int64)
+        self.duration = self.nscans / float(self.rate)
+        self.data = scans(self)
+        self.cached = (None, None)
+
+    #
+    # The index from the trailer, or rebuilt from the block records of an
+    # unfinished file
+    #
+
+    def read_index(self):
+        dtype = index_dtype(self.nchan)
+        size = os.fstat(self.f.fileno()).st_size
+        if size >= HEADER.size + TRAILER.size:
+            self.f.seek(size - TRAILER.size)
+            start, count, magic = TRAILER.unpack(self.f.read(TRAILER.size))
+            if magic == INDEX_MAGIC and \
+               start + count * dtype.itemsize + TRAILER.size == size:
+                self.f.seek(start)
+                return np.frombuffer(self.f.read(count * dtype.itemsize),
+                                     dtype)
+        block = block_dtype(self.nchan)
+        records = []
+        offset = HEADER.size
+        while offset + block.itemsize <= size:
+            self.f.seek(offset)
+            record = np.frombuffer(self.f.read(block.itemsize), block)
+            end = offset + block.itemsize + int(record['nbytes'][0])
+            if end > size or record['nscans'][0] == 0:
+                break
+            entry = np.zeros(1, dtype)
+            entry['offset'] = offset
+            for name in block.names:
+                entry[name] = record[name]
+            records.append(entry)
+            offset = end
+        return np.concatenate(records) if records else np.zeros(0, dtype)
+
+    #
+    # Decoded samples of block k (the last one is kept)
+    #
+
+    def block(self, k):
+        if self.cached[0] == k:
+            return self.cached[1]
+        entry = self.index[k]
+        header = block_dtype(self.nchan).itemsize
+        self.f.seek(int(entry['offset']) + header)
+        payload = self.f.read(int(entry['nbytes']))
+        block = decode(payload, int(entry['nscans']), self.nchan)
+        self.cached = (k, block)
+        return block
+
+    #
+    # int16 scans first..last, decoding only the blocks they fall in
+    #
+
+    def read_scans(self, first, last):
+        first = min(max(first, 0), self.nscans)
+        last = min(max(last, first), self.nscans)
+        if first == last:
+            return np.zeros((0, self.nchan), np.int16)
+        k0 = np.searchsorted(self.starts, first, 'right') - 1
+        k1 = np.searchsorted(self.starts, last, 'left')
+        parts = []
+        for k in range(k0, k1):
+            start = int(self.starts[k])
+            block = self.block(k)
+            parts.append(block[max(first - start, 0):last - start])
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    #
+    # Per-block (first scan, min, max, mean) of t0..t1 seconds, from the
+    # index alone
+    #
+
+    def block_stats(self, t0=0, t1=None):
+        first = self.scan(t0)
+        last = self.nscans if t1 is None else self.scan(t1)
+        k0 = max(np.searchsorted(self.starts, first, 'right') - 1, 0)
+        k1 = np.searchsorted(self.starts, last, 'left')
+        entries = self.index[k0:k1]
+        return (entries['first'], entries['min'], entries['max'],
+                entries['mean'])
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.nscans
+
+    def channel(self, n):
+        return self.data[:, n]
+
+    # The rest of the reader API is that of recording
+    scan = recording.scan
+    read = recording.read
+    chunks = recording.chunks
+
+#
+# Array-like (nscans, nchan) view of a compressed recording: slices are
+# decoded on access
+#
+
+class scans:
+    def __init__(self, rec):
+        ''' Constructor for this class '''
+        self.rec = rec
+        self.shape = (rec.nscans, rec.nchan)
+        self.dtype = np.dtype(np.int16)
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.rec.read_scans(0, self.rec.nscans)
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+        rows, cols = (key if isinstance(key, tuple) else (key, slice(None)))
+        if isinstance(rows, slice) and rows.step in (None, 1):
+            first, last, step = rows.indices(self.shape[0])
+            return self.rec.read_scans(first, last)[:, cols]
+        if isinstance(rows, (int, np.integer)):
+            n = rows % self.shape[0]
+            return self.rec.read_scans(n, n + 1)[0, cols]
+        return np.asarray(self)[rows, cols]
+
+#
+# Open a recording in either format
+#
+# Returns a recording or compressed_recording
+#
+
+def open_recording(filename):
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    if magic == MAGIC:
+        return compressed_recording(filename)
+    return recording(filename)
@@ -0,0 +1,285 @@
+#
+# Persistent acquisition daemon.
+#
+# The daemon owns an open DataQ serial port and keeps the device
+# configured between captures.  Capture jobs arrive over a local Unix
+# socket as one JSON object per line, and each gets one JSON line back:
+#
+#     {"cmd": "capture", "channels": [0, 1, 2], "rate": 10000,
+#      "duration": 0.5, "output": "file"}
+#
+#     {"ok": true, "path": "...wav", "scans": 5000, "Fs": 10000,
+#      "configured": false, "elapsed": 0.503}
+#
+# With "output": "shm" the scans are left in a shared memory block
+# instead ("shm", "shape" and "dtype" in the reply); the client owns the
+# block and must unlink it (see fetch()).  Other commands are "status"
+# and "shutdown".
+#
+# The device is only reconfigured when the channels, rate or decimation
+# of a job differ from the previous one.  Jobs are run one at a time.
+#
+
+import json
+import os
+import socket
+import socketserver
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+from dataq_utilities.pipeline import pipeline, capture
+from dataq_utilities.wav_writer import wav_writer
+
+#
+# Shared memory block that outlives this process until the client unlinks
+# it, so the resource tracker must not clean it up
+#
+# Returns a SharedMemory object
+#
+
+def untracked_shared_memory(size):
+    try:
+        return shared_memory.SharedMemory(create=True, size=size,
+                                          track=False)
+    except TypeError:
+        # Python < 3.13 has no track argument
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+#
+# Captures straight into a shared memory block
+#
+
+class shared_capture(capture):
+    def __init__(self, Max_Samples, nchan):
+        ''' Constructor for this class '''
+        self.shm = untracked_shared_memory(max(Max_Samples * nchan * 2, 1))
+        self.samples = np.ndarray((Max_Samples, nchan), dtype=np.int16,
+                                  buffer=self.shm.buf)
+        self.nscans = 0
+
+    #
+    # Free the block when no reply will hand it to a client
+    #
+
+    def discard(self):
+        self.samples = None
+        self.shm.close()
+        if getattr(self.shm, '_track', True):
+            # Python < 3.13: unlink() unregisters it from the tracker
+            from multiprocessing import resource_tracker
+            resource_tracker.register(self.shm._name, 'shared_memory')
+        self.shm.unlink()
+
+
+class acquisition_daemon:
+    def __init__(self, ser, DataQ, socket_path, directory='.',
+                 max_latency=0.05):
+        ''' Constructor for this class '''
+        self.ser = ser
+        self.DataQ = DataQ
+        self.socket_path = socket_path
+        self.directory = directory
+        self.max_latency = max_latency
+        self.config = None
+        self.Fs = None
+        self.jobs = 0
+        self.reconfigurations = 0
+        self.server = None
+
+    #
+    # Configure the device unless it already runs with these parameters
+    #
+    # Returns True if the device was (re)configured
+    #
+
+    def ensure_config(self, channels, rate, decimation_factor):
+        config = (tuple(channels), rate, decimation_factor)
+        if config == self.config:
+            return False
+        self.config = None
+        self.Fs = self.DataQ.configure(self.ser, list(channels), rate,
+                                       decimation_factor)
+        self.config = config
+        self.reconfigurations += 1
+        return True
+
+    #
+    # Run one capture job
+    #
+    # Returns a dictionary for the reply
+    #
+
+    def capture(self, job):
+        t0 = time.perf_counter()
+        channels = [int(c) for c in job.get('channels', [0, 1, 2])]
+        rate = int(job.get('rate', 10000))
+        decimation_factor = int(job.get('decimation', 1))
+        output = job.get('output', 'file')
+        configured = self.ensure_config(channels, rate, decimation_factor)
+
+        if 'nsamp' in job:
+            Max_Samples = int(job['nsamp'])
+        else:
+            Max_Samples = int(self.Fs * float(job.get('duration', 1.0)))
+
+        acq = pipeline(self.ser, len(channels), Fs=self.Fs,
+                       max_latency=self.max_latency)
+        if output == 'shm':
+            sink = acq.add_sink(shared_capture(Max_Samples, len(channels)))
+        else:
+            sink = acq.add_sink(wav_writer(rate, channels,
+                                           directory=job.get('directory',
+                                                             self.directory)))
+
+        try:
+            self.DataQ.send_command(self.ser, 'start', True)
+            try:
+                acq.run(Max_Samples)
+            finally:
+                self.DataQ.send_command(self.ser, 'stop', False,
+                                        verbose=False)
+                self.ser.reset_input_buffer()
+        except BaseException:
+            if output == 'shm':
+                sink.discard()
+            raise
+        self.jobs += 1
+
+        reply = {'ok': True,
+                 'scans': acq.scans,
+                 'Fs': self.Fs,
+                 'configured': configured,
+                 'overruns': acq.overruns,
+                 'stalled': acq.stalled,
+                 'misaligned': acq.decoder.misaligned}
+        if output == 'shm':
+            reply['shm'] = sink.shm.name
+            reply['shape'] = [Max_Samples, len(channels)]
+            reply['dtype'] = 'int16'
+            sink.samples = None
+            sink.shm.close()
+        else:
+            reply['path'] = os.path.abspath(sink.files[0]) \
+                if sink.files else None
+            reply['files'] = [os.path.abspath(f) for f in sink.files]
+        reply['elapsed'] = time.perf_counter() - t0
+        return reply
+
+    #
+    # Handle one request
+    #
+    # Returns a dictionary for the reply
+    #
+
+    def handle(self, job):
+        cmd = job.get('cmd', 'capture')
+        try:
+            if cmd == 'capture':
+                return self.capture(job)
+            if cmd == 'status':
+                return {'ok': True,
+                        'port': self.ser.port,
+                        'config': self.config,
+                        'Fs': self.Fs,
+                        'jobs': self.jobs,
+                        'reconfigurations': self.reconfigurations}
+            if cmd == 'shutdown':
+                self.running = False
+                return {'ok': True}
+            return {'ok': False, 'error': 'unknown command {}'.format(cmd)}
+        except Exception as err:
+            self.config = None
+            return {'ok': False, 'error': str(err)}
+
+    #
+    # Accept jobs until a shutdown request arrives
+    #
+
+    def serve_forever(self):
+        daemon = self
+
+        class handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        job = json.loads(line)
+                    except ValueError as err:
+                        reply = {'ok': False, 'error': str(err)}
+                    else:
+                        reply = daemon.handle(job)
+                    self.wfile.write((json.dumps(reply) + '\n').encode())
+                    self.wfile.flush()
+                    if not daemon.running:
+                        break
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.running = True
+        self.server = socketserver.UnixStreamServer(self.socket_path,
+                                                    handler)
+        print('Listening on {}'.format(self.socket_path))
+        try:
+            while self.running:
+                self.server.handle_request()
+        finally:
+            self.server.server_close()
+            os.unlink(self.socket_path)
+            self.DataQ.send_command(self.ser, 'stop', False, verbose=False)
+
+#
+# Client side
+#
+
+#
+# Send one request to a running daemon
+#
+# Returns the reply dictionary
+#
+
+def request(socket_path, job, timeout=None):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(socket_path)
+        s.sendall((json.dumps(job) + '\n').encode())
+        f = s.makefile('rb')
+        line = f.readline()
+        f.close()
+    finally:
+        s.close()
+    return json.loads(line)
+
+#
+# Capture through the daemon
+#
+# Returns the reply dictionary (see fetch() for output='shm')
+#
+
+def daemon_capture(socket_path, channels, rate, duration, output='file',
+                   **job):
+    job.update({'cmd': 'capture', 'channels': list(channels), 'rate': rate,
+                'duration': duration, 'output': output})
+    return request(socket_path, job)
+
+#
+# Copy the scans of an output='shm' reply and release the block
+#
+# Returns an (n, nchan) int16 array
+#
+
+def fetch(reply):
+    shape = tuple(reply['shape'])
+    shm = shared_memory.SharedMemory(name=reply['shm'])
+    try:
+        samples = np.ndarray(shape, dtype=reply['dtype'],
+                             buffer=shm.buf)[:reply['scans']].copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return samples
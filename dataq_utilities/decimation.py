@@ -0,0 +1,344 @@
+#
+# Decimation planner and multirate outputs.
+#
+# The DI-1100 can decimate on the device: every `deca` raw scans (1 to
+# 40000) become one streamed scan, combined by the channel filter mode
+# (0 last point, 1 average, 2 maximum, 3 minimum).  The scan rate is
+#
+#     60,000,000 / (srate * dec * deca)    (dec is fixed at 1)
+#
+# with srate at most 65535 and at least 1500, 2000, 2500 or 3000 for 1,
+# 2, 3 or 4 enabled channels (the srate table of the protocol document;
+# see srate_min).  plan_decimation() splits the work:
+#
+#   * The device streams the lowest rate anything needs: the full rate,
+#     or, when the full-rate data is not kept, the highest output rate.
+#     With the average (or max / min) filter the ADC is run as fast as
+#     srate allows and deca raw scans are combined per streamed scan:
+#     free oversampling, anti-aliasing and noise averaging.  With 'last'
+#     deca stays 1, as before, unless the rate is below what srate can
+#     reach (about 916 Hz): a kept full rate then keeps every deca-th
+#     raw scan, and otherwise the device streams a multiple of the
+#     highest output rate that the host decimates.
+#   * Every other output rate is produced on the host by polyphase FIR
+#     decimation (only the kept outputs are computed), in stages of at
+#     most 10, from the nearest faster output it divides, so e.g. a full
+#     rate stream, a 1 kHz and a 100 Hz trend come out of one pass.
+#     Output rates must be whole numbers of Hz (they go to WAV headers)
+#     that divide the stream rate by a factor made of primes up to 10;
+#     others are rejected rather than rounded.
+#
+# The FIR filters are those of scipy.signal.resample_poly (Kaiser window,
+# beta 5, 10 taps per unit of the factor on each side, cutoff at the
+# output Nyquist frequency), centred on the output scans so output k is
+# the input at scan k * factor: decimated files line up in time with the
+# full-rate one.  The ends are extended with the first / last scan.
+#
+# Outputs are int16 scans like the input.  The digital input bits of scan
+# position 0 are not filtered: each output keeps the bits of the input
+# scan it is centred on.
+#
+
+import numpy as np
+from scipy import signal
+
+DIVIDEND = 60000000
+SRATE_FLOOR = [1500, 2000, 2500, 3000]
+SRATE_MAX = 65535
+DECA_MAX = 40000
+FILTERS = ['last', 'avg', 'max', 'min']
+MAX_STAGE = 10
+
+#
+# Prime factors of q
+#
+# Returns a list of ints (smallest first)
+#
+
+def prime_factors(q):
+    primes = []
+    n, p = q, 2
+    while p * p <= n:
+        while n % p == 0:
+            primes.append(p)
+            n //= p
+        p += 1
+    if n > 1:
+        primes.append(n)
+    return primes
+
+#
+# Split a decimation factor into stages of at most max_stage
+#
+# Returns a list of ints (largest first; [] for 1); raises ValueError if
+# a prime factor is larger than max_stage
+#
+
+def stage_factors(q, max_stage=MAX_STAGE):
+    primes = prime_factors(q)
+    if primes and primes[-1] > max_stage:
+        raise ValueError('factor {} has a prime factor above {}'
+                         .format(q, max_stage))
+    stages = []
+    for p in sorted(primes, reverse=True):
+        # Fill the smallest stage that still has room
+        fits = [i for i, s in enumerate(stages) if s * p <= max_stage]
+        if fits:
+            i = min(fits, key=lambda i: stages[i])
+            stages[i] *= p
+        else:
+            stages.append(p)
+    return sorted(stages, reverse=True)
+
+#
+# Lowest srate the device accepts with nchan channels in the scan list
+#
+
+def srate_min(nchan):
+    return SRATE_FLOOR[min(max(nchan, 1), len(SRATE_FLOOR)) - 1]
+
+#
+# Smallest multiplier d (low..high) of a rate for which srate, of
+# 60 MHz / (rate * d), is in range, preferring one that makes it exact;
+# d is the device deca, or how much faster than rate the device streams.
+# With smooth=True only d that split into host stages are taken.
+#
+# Returns an int, or None
+#
+
+def pick_multiplier(rate, low, high, nchan=1, smooth=False):
+    found = None
+    for d in range(max(low, 1), high + 1):
+        if smooth and any(p > MAX_STAGE for p in prime_factors(d)):
+            continue
+        ticks = DIVIDEND / float(rate * d)
+        if not srate_min(nchan) <= int(ticks) <= SRATE_MAX:
+            continue
+        if ticks == int(ticks):
+            return d
+        if found is None:
+            found = d
+    return found
+
+#
+# Device settings and host stages for a full rate and output rates
+#
+# device_filter is one of FILTERS, nchan the number of channels in the
+# scan list (it sets the lowest srate).  With full_rate=False the full-rate
+# stream is not kept and the device streams the highest output rate (or
+# a multiple of it, see above).  Raises ValueError for a rate the device
+# cannot stream or an output rate that cannot be made exactly.
+#
+# Returns a dictionary: rate (to stream), Fs (actual), srate, deca,
+# filter, filter_mode, full_rate, outputs (per output rate, highest
+# first: rate, factor from Fs, actual rate, source output index or None
+# for the stream, stages)
+#
+
+def plan_decimation(rate, outputs=(), device_filter='last', full_rate=True,
+                    nchan=1):
+    if device_filter not in FILTERS:
+        raise ValueError('device filter must be one of {}'.format(FILTERS))
+    outputs = sorted(set(outputs), reverse=True)
+    if not full_rate and not outputs:
+        raise ValueError('nothing to record: no full rate and no outputs')
+    for r in outputs:
+        if r <= 0 or r != int(r):
+            raise ValueError('output rates must be whole numbers of Hz, '
+                             'not {:g}'.format(r))
+    stream = rate if full_rate else outputs[0]
+    if outputs and outputs[0] > stream:
+        raise ValueError('output rates must not exceed {} Hz'.format(stream))
+
+    mode = FILTERS.index(device_filter)
+    lowest = srate_min(nchan)
+    deca = 1
+    slowest = int(np.ceil(DIVIDEND / (stream * float(SRATE_MAX))))
+    if mode != 0:
+        # As much device decimation as srate allows, preferring an exact
+        # stream rate
+        most = max(min(DECA_MAX, int(DIVIDEND / (stream * lowest))), 1)
+        deca = most
+        if stream == int(stream):
+            for d in range(most, 0, -1):
+                if DIVIDEND % (int(stream) * d) == 0 and \
+                   DIVIDEND // (int(stream) * d) <= SRATE_MAX:
+                    deca = d
+                    break
+    elif slowest > 1 and full_rate:
+        # Keep every deca-th scan of a faster ADC
+        deca = pick_multiplier(stream, slowest, DECA_MAX, nchan)
+    elif slowest > 1:
+        # Stream a multiple of the output rate, decimate on the host
+        m = pick_multiplier(stream, slowest,
+                            int(DIVIDEND / (stream * lowest)), nchan,
+                            smooth=True)
+        if m is not None:
+            stream *= m
+    if deca is None:
+        raise ValueError('{} Hz is outside the device range'.format(stream))
+    srate = int(DIVIDEND / stream / deca)
+    if not lowest <= srate <= SRATE_MAX:
+        raise ValueError('{} Hz is outside the device range'.format(stream))
+    Fs = DIVIDEND / float(srate * deca)
+
+    planned = []
+    for r in outputs:
+        q = max(int(round(Fs / r)), 1)
+        if abs(Fs / q - r) > 1e-9 * r:
+            raise ValueError('{:g} Hz is not the {:g} Hz stream divided by '
+                             'a whole number'.format(r, Fs))
+        try:
+            stage_factors(q)
+        except ValueError:
+            raise ValueError('{:g} Hz: decimation by {} does not split into '
+                             'stages of at most {}'.format(r, q, MAX_STAGE))
+        source = None
+        for n, o in enumerate(planned):
+            if q % o['factor'] == 0 and (source is None or
+                                         o['factor'] >
+                                         planned[source]['factor']):
+                source = n
+        step = q if source is None else q // planned[source]['factor']
+        planned.append({'rate': r, 'factor': q, 'actual': Fs / q,
+                        'source': source, 'stages': stage_factors(step)})
+    return {'rate': stream, 'Fs': Fs, 'srate': srate, 'deca': deca,
+            'filter': device_filter, 'filter_mode': mode,
+            'full_rate': full_rate, 'outputs': planned}
+
+#
+# One streaming FIR decimation stage, on float (n, nchan) blocks
+#
+
+class fir_stage:
+    def __init__(self, q, nchan):
+        ''' Constructor for this class '''
+        self.q = q
+        self.nchan = nchan
+        self.half = 10 * q
+        self.h = signal.firwin(2 * self.half + 1, 1.0 / q,
+                               window=('kaiser', 5.0))
+        self.buf = None
+        self.start = 0
+        self.next = 0
+
+    #
+    # Returns the new output scans
+    #
+
+    def process(self, x):
+        if len(x) == 0:
+            return np.zeros((0, self.nchan))
+        if self.buf is None:
+            # Extend the start with the first scan
+            self.buf = np.repeat(x[:1], self.half, axis=0)
+            self.start = -self.half
+        self.buf = np.concatenate((self.buf, x))
+        end = self.start + len(self.buf)
+        n = 0
+        if end - 1 - self.half >= self.next:
+            n = (end - 1 - self.half - self.next) // self.q + 1
+        y = np.zeros((0, self.nchan))
+        if n:
+            # (n, nchan, taps) windows centred on the kept scans only
+            first = self.next - self.half - self.start
+            windows = np.lib.stride_tricks.sliding_window_view(
+                self.buf, len(self.h), axis=0)[first:first + (n - 1) *
+                                               self.q + 1:self.q]
+            y = windows @ self.h
+            self.next += n * self.q
+        keep = self.next - self.half - self.start
+        self.buf = self.buf[keep:]
+        self.start += keep
+        return y
+
+    #
+    # Outputs still owed at the end of the stream
+    #
+
+    def flush(self):
+        if self.buf is None:
+            return np.zeros((0, self.nchan))
+        return self.process(np.repeat(self.buf[-1:], self.half, axis=0))
+
+#
+# Decimate int16 scans by q in stages (see stage_factors)
+#
+
+class decimator:
+    def __init__(self, stages, nchan):
+        ''' Constructor for this class '''
+        self.stages = [fir_stage(q, nchan) for q in stages]
+        self.factor = int(np.prod(stages)) if stages else 1
+        self.nchan = nchan
+        self.scans = 0
+        self.bits = np.zeros(0, np.int16)
+
+    def to_int16(self, y):
+        out = np.clip(np.round(y), -32768, 32767).astype(np.int16)
+        # Digital bits of the scans the outputs are centred on
+        n = len(out)
+        out[:, 0] = (out[:, 0] & np.int16(-4)) | self.bits[:n]
+        self.bits = self.bits[n:]
+        return out
+
+    #
+    # Returns the new (m, nchan) int16 output scans
+    #
+
+    def process(self, samples):
+        if not self.stages:
+            return np.array(samples)
+        first = -self.scans % self.factor
+        self.bits = np.concatenate((self.bits,
+                                    samples[first::self.factor, 0] & 3))
+        self.scans += len(samples)
+        y = samples.astype(np.float64)
+        y[:, 0] = samples[:, 0] & np.int16(-4)
+        for stage in self.stages:
+            y = stage.process(y)
+        return self.to_int16(y)
+
+    def flush(self):
+        if not self.stages:
+            return np.zeros((0, self.nchan), np.int16)
+        y = self.stages[0].flush()
+        for stage in self.stages[1:]:
+            y = np.concatenate((stage.process(y), stage.flush()))
+        return self.to_int16(y)
+
+#
+# Sink that writes the full-rate stream (if full is given) and every
+# output rate of a plan (one sink each) in a single pass
+#
+
+class multirate:
+    def __init__(self, plan, nchan, full=None, sinks=()):
+        ''' Constructor for this class '''
+        self.plan = plan
+        self.full = full
+        self.outputs = plan['outputs']
+        self.sinks = list(sinks)
+        self.decimators = [decimator(o['stages'], nchan)
+                           for o in self.outputs]
+
+    def write(self, samples):
+        if self.full is not None:
+            self.full.write(samples)
+        blocks = []
+        for o, d, sink in zip(self.outputs, self.decimators, self.sinks):
+            source = samples if o['source'] is None else blocks[o['source']]
+            blocks.append(d.process(source))
+            sink.write(blocks[-1])
+
+    def close(self):
+        if self.full is not None:
+            self.full.close()
+        blocks = []
+        for o, d, sink in zip(self.outputs, self.decimators, self.sinks):
+            tail = np.zeros((0, d.nchan), np.int16)
+            if o['source'] is not None:
+                tail = d.process(blocks[o['source']])
+            blocks.append(np.concatenate((tail, d.flush())))
+            sink.write(blocks[-1])
+            sink.close()
@@ -0,0 +1,141 @@
+#
+# Vectorized decoder for DI-1100 binary (encode 0) streams.
+#
+# Raw bytes are turned into (n, nchan) int16 arrays for a scan list of
+# any length.  A partial scan at the end of one call is carried over to
+# the next.
+#
+# The DI-1100 left-justifies its 12-bit ADC values in 16-bit words, so
+# bits 2-3 of every word are always zero and bits 0-1 are only used, for
+# the digital inputs, in the first scan list position.  Those bits are
+# checked on every call.  A word that breaks the pattern means the stream
+# has slipped by a byte or a channel (or carries an ASCII reply such as
+# "stop 01"): the good scans before it are returned, and the decoder
+# searches the following bytes for an offset where the pattern holds again.
+#
+
+import numpy as np
+
+class decoder:
+    def __init__(self, nchan, sync_scans=16, search_scans=8, check=True):
+        ''' Constructor for this class '''
+        self.nchan = nchan
+        self.scan_bytes = 2 * nchan
+        self.sync_scans = sync_scans
+        self.search_bytes = search_scans * self.scan_bytes
+        self.check = check
+
+        # Bits that must be zero, per scan list position
+        self.zero_bits = np.full(nchan, 0x000F, dtype=np.uint16)
+        self.zero_bits[0] = 0x000C
+
+        self.leftover = b''
+        self.last = None
+        self.scans = 0
+        self.misaligned = 0
+        self.skipped_bytes = 0
+
+    #
+    # Rows of words that break the DI-1100 bit pattern
+    #
+    # Returns a boolean array, one entry per scan
+    #
+
+    def bad_scans(self, words):
+        return np.any(words & self.zero_bits, axis=1)
+
+    #
+    # Decode as many whole scans as possible
+    #
+    # Returns an (n, nchan) int16 array
+    #
+
+    def decode(self, data):
+        if self.leftover:
+            data = self.leftover + bytes(data)
+            self.leftover = b''
+        out = []
+        while True:
+            nscans = len(data) // self.scan_bytes
+            words = np.frombuffer(data, dtype='<u2',
+                                  count=nscans * self.nchan)
+            words = words.reshape(nscans, self.nchan)
+            if not self.check:
+                bad = []
+            else:
+                bad = np.flatnonzero(self.bad_scans(words))
+            if len(bad) == 0:
+                # Fast path: everything lined up
+                out.append(words)
+                self.leftover = bytes(data[nscans * self.scan_bytes:])
+                break
+            first = bad[0]
+            out.append(words[:first])
+            if first > 0:
+                self.last = words[first - 1].view(np.int16).astype(np.int32)
+            offset = self.resync(data, first * self.scan_bytes)
+            if offset is None:
+                # Not enough data to decide yet; try again next call
+                self.leftover = bytes(data[first * self.scan_bytes:])
+                keep = self.search_bytes + self.sync_scans * self.scan_bytes
+                if len(self.leftover) > 2 * keep:
+                    # Give up on the oldest bytes rather than grow forever
+                    drop = len(self.leftover) - keep
+                    self.leftover = self.leftover[drop:]
+                    self.skipped_bytes += drop
+                break
+            self.misaligned += 1
+            self.skipped_bytes += int(offset - first * self.scan_bytes)
+            data = data[offset:]
+
+        if len(out) == 1:
+            samples = out[0]
+        else:
+            samples = np.concatenate(out)
+        if len(samples):
+            self.last = samples[-1].view(np.int16).astype(np.int32)
+        self.scans += len(samples)
+        return samples.view(np.int16)
+
+    #
+    # Look for an offset within search_scans scans after start where
+    # sync_scans scans in a row keep the bit pattern.  Offsets where the
+    # digital bits are set in the first position win outright, since they
+    # also pin down the channel order.  Otherwise the offset whose first
+    # scan is closest to the last good scan is taken.
+    #
+    # Returns a byte offset, or None if more data is needed
+    #
+
+    def resync(self, data, start):
+        need = self.sync_scans * self.scan_bytes
+        candidates = []
+        for o in range(start + 1, start + self.search_bytes + 1):
+            if o + need > len(data):
+                return None
+            words = np.frombuffer(data, dtype='<u2', offset=o,
+                                  count=self.sync_scans * self.nchan)
+            words = words.reshape(self.sync_scans, self.nchan)
+            if not np.any(self.bad_scans(words)):
+                if self.nchan == 1 or np.any(words[:, 0] & 0x3):
+                    return o
+                candidates.append((o, words[0]))
+        if candidates:
+            if self.last is None:
+                return candidates[0][0]
+            jumps = [np.abs(w.view(np.int16) - self.last).sum()
+                     for o, w in candidates]
+            return candidates[int(np.argmin(jumps))][0]
+        # Nothing lines up here: skip ahead and keep looking
+        return start + self.search_bytes
+
+    #
+    # Summary of the decoder's work
+    #
+    # Returns a dictionary
+    #
+
+    def report(self):
+        return {'scans': self.scans,
+                'misaligned': self.misaligned,
+                'skipped_bytes': self.skipped_bytes}
@@ -0,0 +1,207 @@
+#
+# Digital input tracks and edge index.
+#
+# The DI-1100 returns its digital inputs in bits 0-1 of scan position 0
+# (see decoder.py); to_volts() masks them off the analog value.  Here
+# they are pulled out as tracks: digital_bits() gives one uint8 per scan
+# (bit b = DIb), pack_tracks() one bit per scan and input (np.packbits,
+# 8 scans per byte).
+#
+# edge_index records the scans where each input rises and falls.  It is
+# fed blocks of int16 scans in order (as a pipeline sink, from
+# wav_writer(edges=True) during acquisition, or from recording.chunks()
+# for an existing file), keeps only the edges, and answers "where is DI0
+# high" with segments() from the edge lists instead of a pass over the
+# samples.  It is saved as a sidecar file next to the recording:
+#
+#     2020-09-14_SR10000_SL200000_CH012_11-25-49.edges.npz
+#
+
+import os
+import numpy as np
+
+NBITS = 2
+
+#
+# Sidecar filename of a recording
+#
+
+def sidecar_name(filename):
+    return os.path.splitext(filename)[0] + '.edges.npz'
+
+#
+# Digital bits of raw int16 samples of scan position 0
+#
+# Returns a uint8 array (bit b is input DIb)
+#
+
+def digital_bits(samples, nbits=NBITS):
+    return (np.asarray(samples) & ((1 << nbits) - 1)).astype(np.uint8)
+
+#
+# Packed tracks of raw int16 samples of scan position 0
+#
+# Returns an (nbits, ceil(n/8)) uint8 array; unpack_tracks(packed, n)
+# reverses it
+#
+
+def pack_tracks(samples, nbits=NBITS):
+    bits = digital_bits(samples, nbits)
+    planes = (bits[np.newaxis, :] >> np.arange(nbits, dtype=np.uint8)
+              [:, np.newaxis]) & 1
+    return np.packbits(planes, axis=-1)
+
+def unpack_tracks(packed, n):
+    return np.unpackbits(packed, axis=-1, count=n)
+
+
+class edge_index:
+    def __init__(self, rate, nbits=NBITS, position=0):
+        ''' Constructor for this class '''
+        self.rate = rate
+        self.nbits = nbits
+        self.position = position
+        self.rising = [[] for b in range(nbits)]
+        self.falling = [[] for b in range(nbits)]
+        self.initial = 0
+        self.last = None
+        self.scans = 0
+
+    #
+    # Sink interface: add (n, nchan) int16 scans
+    #
+
+    def write(self, samples):
+        if len(samples) == 0:
+            return
+        bits = digital_bits(samples[:, self.position], self.nbits)
+        if self.last is None:
+            self.initial = self.last = int(bits[0])
+        x = np.concatenate(([self.last], bits)).astype(np.uint8)
+        changed = np.flatnonzero(x[1:] ^ x[:-1])
+        if len(changed):
+            before, after = x[changed], x[changed + 1]
+            for b in range(self.nbits):
+                flips = ((before ^ after) >> b) & 1 == 1
+                up = (after >> b) & 1 == 1
+                self.rising[b].append(self.scans + changed[flips & up])
+                self.falling[b].append(self.scans + changed[flips & ~up])
+        self.last = int(bits[-1])
+        self.scans += len(bits)
+
+    def close(self):
+        pass
+
+    #
+    # Edges of input bit
+    #
+    # Returns (rising, falling): int64 arrays of the first scan after
+    # each edge
+    #
+
+    def edges(self, bit):
+        for lists in (self.rising, self.falling):
+            if len(lists[bit]) != 1:
+                lists[bit][:] = [np.concatenate(lists[bit]).astype(np.int64)
+                                 if lists[bit] else np.zeros(0, np.int64)]
+        return self.rising[bit][0], self.falling[bit][0]
+
+    #
+    # Value of input bit at a scan
+    #
+
+    def state(self, bit, scan):
+        rising, falling = self.edges(bit)
+        return ((self.initial >> bit) & 1) + \
+            int(np.searchsorted(rising, scan, 'right')) - \
+            int(np.searchsorted(falling, scan, 'right'))
+
+    #
+    # Segments where input bit is at level (1: high), within scans
+    # first..last
+    #
+    # Returns an (n, 2) int64 array of [start, stop) scans
+    #
+
+    def segments(self, bit, level=1, first=0, last=None):
+        if last is None or last > self.scans:
+            last = self.scans
+        rising, falling = self.edges(bit)
+        starts, stops = (rising, falling) if level else (falling, rising)
+        # Only the edges inside the window are touched
+        starts = starts[np.searchsorted(starts, first, 'right'):
+                        np.searchsorted(starts, last, 'left')]
+        stops = stops[np.searchsorted(stops, first, 'right'):
+                      np.searchsorted(stops, last, 'left')]
+        if first < last and self.state(bit, first) == level:
+            starts = np.concatenate(([first], starts))
+        if len(stops) < len(starts):
+            stops = np.concatenate((stops, [last]))
+        return np.column_stack((starts, stops)).astype(np.int64)
+
+    #
+    # Segments in seconds
+    #
+    # Returns an (n, 2) float array of [start, stop) times
+    #
+
+    def segment_times(self, bit, level=1, t0=0, t1=None):
+        last = None if t1 is None else int(round(t1 * self.rate))
+        return self.segments(bit, level, int(round(t0 * self.rate)),
+                             last) / float(self.rate)
+
+    def save(self, filename):
+        arrays = {}
+        for b in range(self.nbits):
+            arrays['rising{}'.format(b)], arrays['falling{}'.format(b)] = \
+                self.edges(b)
+        np.savez(filename, rate=self.rate, nbits=self.nbits,
+                 position=self.position, initial=self.initial,
+                 scans=self.scans, **arrays)
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as f:
+            e = edge_index(int(f['rate']), int(f['nbits']),
+                           int(f['position']))
+            e.initial = int(f['initial'])
+            e.scans = int(f['scans'])
+            for b in range(e.nbits):
+                e.rising[b] = [f['rising{}'.format(b)]]
+                e.falling[b] = [f['falling{}'.format(b)]]
+        if e.scans:
+            e.last = sum(e.state(b, e.scans - 1) << b for b in range(e.nbits))
+        return e
+
+    #
+    # Build the edge index of a recording in one chunked pass
+    #
+
+    @staticmethod
+    def build(rec, chunk_scans=65536, nbits=NBITS, position=0):
+        e = edge_index(rec.rate, nbits)
+        for first, block in rec.chunks(chunk_scans, channels=[position],
+                                       raw=True):
+            e.write(block)
+        return e
+
+#
+# The edge index of a recording: from its sidecar file if that is up to
+# date, otherwise built (and saved, if the directory is writable)
+#
+
+def edges_for(rec, save=True):
+    filename = sidecar_name(rec.filename)
+    try:
+        e = edge_index.load(filename)
+        if e.scans == rec.nscans:
+            return e
+    except (OSError, ValueError, KeyError):
+        pass
+    e = edge_index.build(rec)
+    if save:
+        try:
+            e.save(filename)
+        except OSError:
+            pass
+    return e
@@ -0,0 +1,269 @@
+#
+# A software stand-in for the DataQ DI-1100.
+#
+# The emulator owns the master side of a pseudo-terminal and answers the
+# part of the DataQ serial protocol used by Data_acq.py.  The slave side
+# (emulator.port) can be opened with pyserial exactly like the real
+# device, so the acquisition scripts can be exercised without hardware.
+#
+# Supported commands: info, stop, start, encode, ps, dec, deca, filter,
+# slist, srate and led.  Only the binary output mode (encode 0) streams
+# data.  Scan data follows the DI-1100 binary format: a 12-bit two's
+# complement value left-justified in a little-endian int16 word, with the
+# two digital inputs in bits 0-1 of the first scan list position.
+#
+# srate is clamped to the device's range, 65535 down to a floor that
+# depends on the number of channels in the scan list (see srate_min in
+# decimation.py), and the clamped value is echoed, so a host that checks
+# the echo sees a rate the device cannot run.
+#
+# Like the real device, the emulator has a 1024-sample output buffer.  If
+# the host does not drain the link fast enough the buffer overflows, the
+# emulator stops scanning and sends "stop 01".
+#
+
+import os
+import pty
+import tty
+import time
+import select
+import threading
+import numpy as np
+
+from dataq_utilities.decimation import srate_min, SRATE_MAX
+
+class emulator:
+    def __init__(self, slist=[0, 1, 2], srate=6000, waveform='ramp'):
+        ''' Constructor for this class '''
+        self.model = 1100
+        self.dividend = 60000000
+        self.fifo_samples = 1024
+        self.waveform = waveform
+
+        # Device state as set by the protocol commands
+        self.slist = list(slist)
+        self.srate = srate
+        self.dec = 1
+        self.deca = 1
+        self.encode = 0
+        self.ps = 0
+        self.filters = {}
+        self.led = 0
+
+        # Streaming state
+        self.scanning = False
+        self.fifo = bytearray()
+        self.scans_sent = 0
+        self.bytes_sent = 0
+        self.dropped_bytes = 0
+        self.overflows = 0
+        self.start_time = None
+        self.stop_time = None
+        self.commands = []
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+
+        self.running = False
+        self.thread = None
+
+    #
+    # Start and stop the emulator thread
+    #
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.port
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        os.close(self.master)
+        os.close(self.slave)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #
+    # Per-channel sampling rate as defined by srate, dec and deca
+    #
+    # Returns a float (Hz)
+    #
+
+    def rate(self):
+        return self.dividend / (self.srate * self.dec * self.deca)
+
+    #
+    # Deterministic scan data, so the host side can check what it got.
+    # Scan n always has the same value regardless of read timing.
+    #
+    # Returns an int16 array of shape (count, len(slist))
+    #
+
+    def scan_values(self, first, count, nchan=None):
+        if nchan is None:
+            nchan = len(self.slist)
+        n = np.arange(first, first + count, dtype=np.int64)[:, None]
+        k = np.arange(nchan, dtype=np.int64)[None, :]
+        if self.waveform == 'sine':
+            fs = self.rate()
+            f = 50.0 * (k + 1)
+            counts = np.round(2000 * np.sin(2 * np.pi * f * n / fs))
+            counts = counts.astype(np.int64)
+        else:
+            counts = (n + 1365 * k) % 4096 - 2048
+        words = (counts << 4) & 0xFFF0
+        # Digital inputs D0/D1 live in the first scan list position
+        words[:, 0] |= (n[:, 0] >> 10) & 0x3
+        return words.astype(np.uint16).view(np.int16)
+
+    #
+    # Emulator main loop: read commands, stream scans, drain the buffer
+    #
+
+    def run(self):
+        line = bytearray()
+        while self.running:
+            try:
+                ready, _, _ = select.select([self.master], [], [], 0.001)
+            except (OSError, ValueError):
+                break
+            if ready:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    data = b''
+                for c in data:
+                    if c in (0x0d, 0x0a):
+                        if line:
+                            self.command(line.decode(errors='replace'))
+                            line = bytearray()
+                    else:
+                        line.append(c)
+            if self.scanning:
+                self.produce()
+            self.drain()
+
+    def produce(self):
+        nchan = len(self.slist)
+        due = int((time.perf_counter() - self.start_time) * self.rate())
+        count = due - self.scans_sent
+        if count <= 0:
+            return
+        block = self.scan_values(self.scans_sent, count).tobytes()
+        self.scans_sent = due
+        room = self.fifo_samples * 2 - len(self.fifo)
+        if len(block) > room:
+            # 1024-sample buffer overflowed: stop and report it
+            self.fifo += block[:room]
+            self.dropped_bytes += len(block) - room
+            self.overflows += 1
+            self.scanning = False
+            self.stop_time = time.perf_counter()
+            self.reply('stop 01')
+            return
+        self.fifo += block
+
+    def drain(self):
+        if not self.fifo:
+            return
+        # The device ships data in packets of the configured size
+        packet = 16 << self.ps
+        if self.scanning:
+            n = len(self.fifo) - len(self.fifo) % packet
+        else:
+            n = len(self.fifo)
+        if n == 0:
+            return
+        try:
+            written = os.write(self.master, bytes(self.fifo[:n]))
+        except BlockingIOError:
+            return
+        except OSError:
+            self.running = False
+            return
+        del self.fifo[:written]
+        self.bytes_sent += written
+
+    def clamp_srate(self, srate):
+        return min(max(srate, srate_min(len(self.slist))), SRATE_MAX)
+
+    def reply(self, text):
+        self.fifo += (text + '\r').encode()
+
+    #
+    # Protocol command handler
+    #
+
+    def command(self, text):
+        self.commands.append((time.perf_counter(), text))
+        words = text.strip(chr(0)).split()
+        if not words:
+            return
+        cmd, args = words[0], words[1:]
+        if cmd == 'start':
+            # start is never echoed
+            self.fifo = bytearray()
+            self.scans_sent = 0
+            self.start_time = time.perf_counter()
+            self.stop_time = None
+            # The scan list may have grown since srate was set
+            self.srate = self.clamp_srate(self.srate)
+            self.scanning = (self.encode == 0)
+            return
+        if cmd == 'stop':
+            if self.scanning:
+                self.stop_time = time.perf_counter()
+            self.scanning = False
+            self.reply('stop')
+            return
+        if cmd == 'info':
+            info = {'0': 'DATAQ',
+                    '1': str(self.model),
+                    '2': '65',
+                    '6': '00000000',
+                    '9': str(self.dividend)}
+            arg = args[0] if args else '0'
+            self.reply('info {} {}'.format(arg, info.get(arg, '0')))
+            return
+        if cmd == 'slist' and len(args) == 2:
+            position, config = int(args[0]), int(args[1])
+            if position == 0:
+                self.slist = [config]
+            elif position == len(self.slist):
+                self.slist.append(config)
+            else:
+                self.slist[position] = config
+        elif cmd == 'srate' and args:
+            self.srate = self.clamp_srate(int(args[0]))
+            words = ['srate', str(self.srate)]
+        elif cmd == 'srate':
+            self.reply('srate {}'.format(self.srate))
+            return
+        elif cmd == 'ps' and args:
+            self.ps = min(max(int(args[0]), 0), 7)
+        elif cmd == 'ps':
+            self.reply('ps {}'.format(16 << self.ps))
+            return
+        elif cmd == 'encode' and args:
+            self.encode = int(args[0])
+        elif cmd == 'dec' and args:
+            # dec is fixed at 1 on the DI-1100
+            self.dec = 1
+        elif cmd == 'deca' and args:
+            self.deca = min(max(int(args[0]), 1), 40000)
+        elif cmd == 'filter' and len(args) == 2:
+            self.filters[int(args[0])] = int(args[1])
+        elif cmd == 'led' and args:
+            self.led = int(args[0])
+        self.reply(' '.join(words))
@@ -0,0 +1,323 @@
+#
+# Synchronized acquisition from several DataQ devices.
+#
+# All devices are opened and configured in parallel (one thread each),
+# then started back to back from one thread so the start commands leave
+# the host within microseconds of each other.  Every device gets its own
+# pipeline (one reader thread per device), and a merger lines the streams
+# up on a common timeline and hands one multichannel stream to a single
+# sink, e.g. a wav_writer with all channels.
+#
+# Skew correction: for every block, (block arrival time - scans so far /
+# Fs) is an upper bound on when that device took its first scan; the
+# smallest value seen over the first settle_time seconds estimates it.
+# Devices that started earlier have their leading scans dropped so that
+# row n of the merged stream is the same instant on every device.
+#
+# The merger holds the scans of devices that are ahead until the others
+# catch up.  If one device stalls or drifts more than max_lag seconds
+# behind the rest, the buffers would grow without limit: the merger
+# drops what it holds and fails instead (error, lagging), every device's
+# next block stops its pipeline, and capture() raises.
+#
+
+import threading
+import time
+import numpy as np
+import serial
+
+from dataq_utilities.serial_commands import dataq
+from dataq_utilities.pipeline import pipeline
+
+#
+# Lines up the per-device streams and feeds the combined scans to a sink
+#
+
+class merger:
+    def __init__(self, sink, nchans, Fs, settle_time=0.1, max_lag=0.5):
+        ''' Constructor for this class '''
+        self.sink = sink
+        self.nchans = list(nchans)
+        self.ndev = len(self.nchans)
+        self.Fs = Fs
+        self.settle_scans = max(int(settle_time * Fs), 1)
+        self.max_pending = max(int(max_lag * Fs), 1)
+        self.lock = threading.Lock()
+        self.error = None
+        self.lagging = None
+
+        self.pending = [[] for n in range(self.ndev)]
+        self.available = [0] * self.ndev
+        self.received = [0] * self.ndev
+        self.first_scan = [np.inf] * self.ndev
+        self.skip = None
+        self.skew = None
+        self.scans = 0
+
+    #
+    # Called from device dev's consumer thread
+    #
+
+    def write(self, dev, samples, block_time):
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            self.received[dev] += len(samples)
+            if block_time is not None:
+                estimate = block_time - self.received[dev] / self.Fs
+                self.first_scan[dev] = min(self.first_scan[dev], estimate)
+            self.pending[dev].append(samples.copy())
+            self.available[dev] += len(samples)
+            if self.skip is None:
+                if min(self.received) < self.settle_scans:
+                    self.check_lag(self.received, self.settle_scans)
+                    return
+                self.align()
+            self.flush()
+            self.check_lag(self.available, 0)
+
+    #
+    # Fail if the scans held for the devices that are ahead (counts, less
+    # allowance) exceed max_pending
+    #
+
+    def check_lag(self, counts, allowance):
+        if max(counts) - min(counts) - allowance <= self.max_pending:
+            return
+        self.lagging = int(np.argmin(counts))
+        self.error = RuntimeError('device {} fell more than {:g} s behind'
+                                  .format(self.lagging,
+                                          self.max_pending / self.Fs))
+        self.pending = [[] for n in range(self.ndev)]
+        self.available = [0] * self.ndev
+        raise self.error
+
+    #
+    # Decide how many leading scans to drop from each device
+    #
+
+    def align(self):
+        latest = max(self.first_scan)
+        self.skew = [latest - t for t in self.first_scan]
+        self.skip = [int(round(s * self.Fs)) for s in self.skew]
+        for dev in range(self.ndev):
+            self.drop(dev, self.skip[dev])
+
+    def drop(self, dev, n):
+        while n > 0 and self.pending[dev]:
+            head = self.pending[dev][0]
+            if len(head) <= n:
+                n -= len(head)
+                self.available[dev] -= len(head)
+                self.pending[dev].pop(0)
+            else:
+                self.pending[dev][0] = head[n:]
+                self.available[dev] -= n
+                n = 0
+        # Not enough buffered yet: drop the rest as it arrives
+        self.skip[dev] = n
+
+    def take(self, dev, n):
+        parts, need = [], n
+        while need > 0:
+            head = self.pending[dev][0]
+            if len(head) <= need:
+                parts.append(head)
+                need -= len(head)
+                self.pending[dev].pop(0)
+            else:
+                parts.append(head[:need])
+                self.pending[dev][0] = head[need:]
+                need = 0
+        self.available[dev] -= n
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+    def flush(self):
+        for dev in range(self.ndev):
+            if self.skip[dev]:
+                self.drop(dev, self.skip[dev])
+        n = min(self.available)
+        if n <= 0:
+            return
+        rows = np.hstack([self.take(dev, n) for dev in range(self.ndev)])
+        self.sink.write(rows)
+        self.scans += n
+
+    def close(self):
+        with self.lock:
+            if self.error is None and self.skip is None and \
+               min(self.received) > 0:
+                self.align()
+                self.flush()
+        self.sink.close()
+
+#
+# Per-device sink that forwards to the merger with the block time
+#
+
+class merger_input:
+    def __init__(self, merge, dev, acq):
+        ''' Constructor for this class '''
+        self.merge = merge
+        self.dev = dev
+        self.acq = acq
+
+    def write(self, samples):
+        self.merge.write(self.dev, samples, self.acq.block_time)
+
+    def close(self):
+        pass
+
+
+class device_group:
+    def __init__(self, ports, slist, desired_rate, decimation_factor=1,
+                 max_latency=0.05, baudrate='1382400'):
+        ''' Constructor for this class '''
+        self.ports = list(ports)
+        # One scan list for all devices, or one per device
+        if slist and isinstance(slist[0], (list, tuple)):
+            self.slists = [list(s) for s in slist]
+        else:
+            self.slists = [list(slist) for p in self.ports]
+        self.desired_rate = desired_rate
+        self.decimation_factor = decimation_factor
+        self.max_latency = max_latency
+        self.baudrate = baudrate
+        self.devices = [dataq() for p in self.ports]
+        self.sers = []
+        self.Fs = None
+        self.start_times = []
+
+    #
+    # Run fcn(index) for every device in its own thread
+    #
+
+    def parallel(self, fcn):
+        errors = [None] * len(self.ports)
+
+        def run(n):
+            try:
+                fcn(n)
+            except Exception as err:
+                errors[n] = err
+
+        threads = [threading.Thread(target=run, args=(n,))
+                   for n in range(len(self.ports))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for n, err in enumerate(errors):
+            if err is not None:
+                raise RuntimeError('{}: {}'.format(self.ports[n], err))
+
+    #
+    # Open and configure every device in parallel
+    #
+    # Returns the common sampling rate
+    #
+
+    def open(self):
+        self.sers = [serial.Serial() for p in self.ports]
+        rates = [None] * len(self.ports)
+
+        def setup(n):
+            ser = self.sers[n]
+            ser.port = self.ports[n]
+            ser.baudrate = self.baudrate
+            ser.timeout = 0
+            ser.open()
+            rates[n] = self.devices[n].configure(ser, self.slists[n],
+                                                 self.desired_rate,
+                                                 self.decimation_factor)
+
+        self.parallel(setup)
+        if len(set(rates)) != 1:
+            raise RuntimeError('Devices disagree on sampling rate: {}'
+                               .format(rates))
+        self.Fs = rates[0]
+        return self.Fs
+
+    #
+    # Start all devices back to back
+    #
+
+    def start(self):
+        command = 'start\r'.encode()
+        self.start_times = []
+        for ser in self.sers:
+            ser.write(command)
+            self.start_times.append(time.perf_counter())
+
+    def stop(self):
+        def halt(n):
+            self.devices[n].send_command(self.sers[n], 'stop', False,
+                                         verbose=False)
+            self.sers[n].reset_input_buffer()
+        self.parallel(halt)
+
+    def close(self):
+        for ser in self.sers:
+            ser.close()
+        self.sers = []
+
+    #
+    # Acquire Max_Samples aligned scans from every device into one sink
+    #
+    # Returns the merger (for scans and skew); raises RuntimeError if a
+    # device fell more than max_lag seconds behind (the sink is closed
+    # with the scans merged until then)
+    #
+
+    def capture(self, Max_Samples, sink, settle_time=0.1, max_lag=0.5):
+        merge = merger(limited(sink, Max_Samples),
+                       [len(s) for s in self.slists], self.Fs, settle_time,
+                       max_lag)
+        # Read a little extra so every device still has Max_Samples after
+        # its leading scans are dropped
+        extra = int(self.Fs * (settle_time + self.max_latency))
+        self.pipelines = []
+        for n, ser in enumerate(self.sers):
+            acq = pipeline(ser, len(self.slists[n]), Fs=self.Fs,
+                           max_latency=self.max_latency)
+            acq.add_sink(merger_input(merge, n, acq))
+            self.pipelines.append(acq)
+
+        self.start()
+        for acq in self.pipelines:
+            acq.start(Max_Samples + extra)
+        errors = []
+        try:
+            for acq in self.pipelines:
+                try:
+                    acq.wait()
+                except Exception as err:
+                    errors.append(err)
+        finally:
+            self.stop()
+            merge.close()
+        if merge.error is not None:
+            raise RuntimeError('{}: {}'.format(self.ports[merge.lagging],
+                                               merge.error))
+        if errors:
+            raise errors[0]
+        return merge
+
+#
+# Passes at most Max_Samples scans on to a sink
+#
+
+class limited:
+    def __init__(self, sink, Max_Samples):
+        ''' Constructor for this class '''
+        self.sink = sink
+        self.remaining = Max_Samples
+
+    def write(self, samples):
+        n = min(len(samples), self.remaining)
+        if n > 0:
+            self.sink.write(samples[:n])
+            self.remaining -= n
+
+    def close(self):
+        self.sink.close()
@@ -0,0 +1,215 @@
+#
+# Min/max overview pyramid for fast time plots.
+#
+# Level 0 holds the minimum and maximum of every `base` scans of every
+# channel, level k of every base * factor**k scans.  To plot any time
+# range at a given pixel width, envelope() picks the coarsest level that
+# still has at least one bucket per pixel, so about 2 x width points are
+# drawn whatever the zoom, and every peak stays visible (the extremes of
+# a bucket are kept, not a sample of it).  Below the finest level the
+# samples themselves are read from the recording.
+#
+# The pyramid is built incrementally: write() takes blocks of int16
+# scans, as a pipeline sink or from wav_writer(overview=True) during
+# acquisition, or from recording.chunks() for an existing file.  It is
+# saved as a sidecar file next to the recording:
+#
+#     2020-09-14_SR10000_SL200000_CH012_11-25-49.minmax.npz
+#
+# Values are raw int16 counts, like the recording (see recording.to_volts).
+#
+
+import os
+import numpy as np
+
+#
+# Sidecar filename of a recording
+#
+
+def sidecar_name(filename):
+    return os.path.splitext(filename)[0] + '.minmax.npz'
+
+
+class minmax_pyramid:
+    def __init__(self, nchan, rate, base=64, factor=4, levels=10):
+        ''' Constructor for this class '''
+        self.nchan = nchan
+        self.rate = rate
+        self.base = base
+        self.factor = factor
+        self.nlevels = levels
+        self.mins = [[] for k in range(levels)]
+        self.maxs = [[] for k in range(levels)]
+        # Buckets of each level not yet reduced into the next one
+        self.tails = [(np.zeros((0, nchan), np.int16),
+                       np.zeros((0, nchan), np.int16))
+                      for k in range(levels)]
+        self.carry = np.zeros((0, nchan), np.int16)
+        self.scans = 0
+        self.finished = False
+
+    def bucket_scans(self, k):
+        return self.base * self.factor ** k
+
+    #
+    # Sink interface: add (n, nchan) int16 scans
+    #
+
+    def write(self, samples):
+        x = np.concatenate((self.carry, samples))
+        n = len(x) // self.base
+        if n:
+            rows = x[:n * self.base].reshape(n, self.base, self.nchan)
+            self.add(0, rows.min(axis=1), rows.max(axis=1))
+        self.carry = x[n * self.base:].copy()
+        self.scans += len(samples)
+
+    def add(self, k, mins, maxs):
+        self.mins[k].append(mins)
+        self.maxs[k].append(maxs)
+        if k + 1 == self.nlevels:
+            return
+        tmin = np.concatenate((self.tails[k][0], mins))
+        tmax = np.concatenate((self.tails[k][1], maxs))
+        m = len(tmin) // self.factor
+        if m:
+            f = self.factor
+            self.add(k + 1,
+                     tmin[:m * f].reshape(m, f, self.nchan).min(axis=1),
+                     tmax[:m * f].reshape(m, f, self.nchan).max(axis=1))
+        self.tails[k] = (tmin[m * self.factor:], tmax[m * self.factor:])
+
+    #
+    # Close the last (partial) bucket of every level; no writes after this
+    #
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        if len(self.carry):
+            self.mins[0].append(self.carry.min(axis=0, keepdims=True))
+            self.maxs[0].append(self.carry.max(axis=0, keepdims=True))
+            self.tails[0] = (np.concatenate((self.tails[0][0],
+                                             self.mins[0][-1])),
+                             np.concatenate((self.tails[0][1],
+                                             self.maxs[0][-1])))
+        for k in range(self.nlevels - 1):
+            tmin, tmax = self.tails[k]
+            if len(tmin):
+                self.mins[k + 1].append(tmin.min(axis=0, keepdims=True))
+                self.maxs[k + 1].append(tmax.max(axis=0, keepdims=True))
+                self.tails[k + 1] = (np.concatenate((self.tails[k + 1][0],
+                                                     self.mins[k + 1][-1])),
+                                     np.concatenate((self.tails[k + 1][1],
+                                                     self.maxs[k + 1][-1])))
+
+    def close(self):
+        self.finish()
+
+    #
+    # (mins, maxs) of level k, as (nbuckets, nchan) arrays
+    #
+
+    def level(self, k):
+        for buckets in (self.mins[k], self.maxs[k]):
+            if len(buckets) != 1:
+                buckets[:] = [np.concatenate(buckets) if buckets else
+                              np.zeros((0, self.nchan), np.int16)]
+        return self.mins[k][0], self.maxs[k][0]
+
+    #
+    # Envelope of t0..t1 seconds at width pixels
+    #
+    # With rec (the recording) ranges finer than the base bucket are read
+    # from the samples.
+    #
+    # Returns (t, lo, hi): bucket start times and (n, nchan) int16 minima
+    # and maxima, n <= about width (lo == hi for raw samples)
+    #
+
+    def envelope(self, t0, t1, width, rec=None):
+        first = max(int(t0 * self.rate), 0)
+        last = min(int(np.ceil(t1 * self.rate)), self.scans)
+        span = max(last - first, 1)
+        per_pixel = span / float(max(width, 1))
+
+        if per_pixel < self.base and rec is not None:
+            data = rec.data[first:last]
+            step = max(int(per_pixel), 1)
+            n = len(data) // step
+            if step == 1:
+                lo = hi = np.asarray(data)
+            else:
+                rows = data[:n * step].reshape(n, step, self.nchan)
+                lo, hi = rows.min(axis=1), rows.max(axis=1)
+            t = (first + np.arange(len(lo)) * step) / float(self.rate)
+            return t, lo, hi
+
+        k = 0
+        while k + 1 < self.nlevels and \
+                self.bucket_scans(k + 1) <= per_pixel and \
+                len(self.level(k + 1)[0]):
+            k += 1
+        size = self.bucket_scans(k)
+        mins, maxs = self.level(k)
+        a = first // size
+        b = min(-(-last // size), len(mins))
+        t = np.arange(a, b) * size / float(self.rate)
+        return t, mins[a:b], maxs[a:b]
+
+    def save(self, filename):
+        self.finish()
+        arrays = {}
+        for k in range(self.nlevels):
+            arrays['min{}'.format(k)], arrays['max{}'.format(k)] = \
+                self.level(k)
+        np.savez(filename, nchan=self.nchan, rate=self.rate, base=self.base,
+                 factor=self.factor, levels=self.nlevels, scans=self.scans,
+                 **arrays)
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as f:
+            p = minmax_pyramid(int(f['nchan']), int(f['rate']),
+                               int(f['base']), int(f['factor']),
+                               int(f['levels']))
+            p.scans = int(f['scans'])
+            for k in range(p.nlevels):
+                p.mins[k] = [f['min{}'.format(k)]]
+                p.maxs[k] = [f['max{}'.format(k)]]
+        p.finished = True
+        return p
+
+    #
+    # Build the pyramid of a recording in one chunked pass
+    #
+
+    @staticmethod
+    def build(rec, chunk_scans=65536, **params):
+        p = minmax_pyramid(rec.nchan, rec.rate, **params)
+        for first, block in rec.chunks(chunk_scans, raw=True):
+            p.write(block)
+        p.finish()
+        return p
+
+#
+# The pyramid of a recording: from its sidecar file if that is up to
+# date, otherwise built (and saved, if the directory is writable)
+#
+
+def overview_for(rec, save=True):
+    filename = sidecar_name(rec.filename)
+    try:
+        p = minmax_pyramid.load(filename)
+        if p.scans == rec.nscans and p.nchan == rec.nchan:
+            return p
+    except (OSError, ValueError, KeyError):
+        pass
+    p = minmax_pyramid.build(rec)
+    if save:
+        try:
+            p.save(filename)
+        except OSError:
+            pass
+    return p
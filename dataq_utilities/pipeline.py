@@ -0,0 +1,344 @@
+#
+# Threaded producer/consumer acquisition pipeline.
+#
+# A reader thread does blocking reads (with a timeout) from the serial
+# port into fixed-size blocks taken from a preallocated pool and pushes
+# them through a bounded queue.  A consumer thread decodes each block into
+# an (n, nchan) int16 array (see decoder.py) and hands it to every sink in
+# turn, then returns the block to the pool.
+#
+# With Fs given, reads are sized adaptively (see read_policy.py): the
+# reader drains whatever is buffered, in whole scans, at an interval that
+# follows the backlog, and blocks hold at most max_latency seconds of
+# data.  Otherwise every read fills a fixed num_samp_per_read block.
+#
+# With a telemetry object (see telemetry.py) the reader and consumer also
+# record backlog, read and delivery times; without one they skip it.
+#
+# If no data arrives for stall_timeout seconds the reader gives up and
+# sets stalled, rather than waiting forever on a device that has stopped.
+#
+# When the consumer falls behind, the pool runs dry and the reader has to
+# wait for a block to be returned (backpressure).  Every such wait is
+# counted as an overrun: while the reader waits, the device's own buffer
+# is filling.
+#
+# A sink is any object with write(samples) and close() methods.  The
+# array passed to write() is a view of a pooled block that is reused as
+# soon as write() returns, so sinks must copy anything they keep.
+#
+
+import queue
+import threading
+import time
+import numpy as np
+
+from dataq_utilities.acquisition import readinto
+from dataq_utilities.decoder import decoder
+from dataq_utilities.read_policy import adaptive_read
+
+class pipeline:
+    def __init__(self, ser, nchan, num_samp_per_read=32, queue_blocks=64,
+                 timeout=0.1, Fs=None, max_latency=0.05, stall_timeout=2.0,
+                 telemetry=None):
+        ''' Constructor for this class '''
+        self.ser = ser
+        self.nchan = nchan
+        self.scan_bytes = 2 * nchan
+        if Fs is None:
+            self.policy = None
+            self.block_bytes = self.scan_bytes * num_samp_per_read
+        else:
+            self.policy = adaptive_read(self.scan_bytes, Fs, max_latency)
+            self.block_bytes = self.policy.block_bytes
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.sinks = []
+        self.telemetry = telemetry
+        if telemetry is not None:
+            telemetry.pipeline = self
+
+        # Block pool: the reader only ever fills blocks from here
+        self.free = queue.Queue()
+        for n in range(queue_blocks + 2):
+            self.free.put(bytearray(self.block_bytes))
+        self.full = queue.Queue(maxsize=queue_blocks)
+
+        self.running = False
+        self.reader_thread = None
+        self.consumer_thread = None
+        self.error = None
+        self.decoder = decoder(nchan)
+        self.block_time = None
+        self.stalled = False
+
+        # Counters
+        self.bytes_read = 0
+        self.scans = 0
+        self.blocks = 0
+        self.overruns = 0
+        self.max_queued = 0
+        self.wait_time = 0.0
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    #
+    # Start the reader and consumer threads
+    #
+    # Reading stops after max_scans scans (None: until stop() is called)
+    #
+
+    def start(self, max_scans=None):
+        if max_scans is None:
+            self.max_bytes = None
+        else:
+            self.max_bytes = max_scans * self.scan_bytes
+        self.ser.timeout = self.timeout
+        self.running = True
+        self.consumer_thread = threading.Thread(target=self.consumer,
+                                                daemon=True)
+        self.reader_thread = threading.Thread(target=self.reader,
+                                              daemon=True)
+        self.consumer_thread.start()
+        self.reader_thread.start()
+
+    #
+    # Stop reading, let the consumer drain the queue and close the sinks
+    #
+
+    def stop(self):
+        self.running = False
+        self.wait()
+
+    def wait(self):
+        if self.reader_thread is not None:
+            self.reader_thread.join()
+            self.reader_thread = None
+        if self.consumer_thread is not None:
+            self.consumer_thread.join()
+            self.consumer_thread = None
+        if self.error is not None:
+            raise self.error
+
+    #
+    # Acquire max_scans scans and wait for the sinks to finish
+    #
+    # Returns the number of scans delivered to the sinks
+    #
+
+    def run(self, max_scans):
+        self.start(max_scans)
+        self.wait()
+        return self.scans
+
+    #
+    # Reader thread: fill pooled blocks and queue them
+    #
+
+    def reader(self):
+        try:
+            while self.running:
+                want = self.block_bytes
+                if self.max_bytes is not None:
+                    want = min(want, self.max_bytes - self.bytes_read)
+                    if want <= 0:
+                        break
+                try:
+                    block = self.free.get_nowait()
+                except queue.Empty:
+                    # Consumer is behind: wait for a block to come back
+                    self.overruns += 1
+                    t0 = time.perf_counter()
+                    block = self.free.get()
+                    self.wait_time += time.perf_counter() - t0
+                view = memoryview(block)
+                last_data = t0 = time.perf_counter()
+                if self.policy is not None:
+                    # Read what is buffered now, in whole scans
+                    n = 0
+                    while n == 0 and self.running:
+                        n = self.policy.wait(self.ser, want, self.timeout)
+                        self.check_stall(n, last_data)
+                    want = n
+                    backlog = self.policy.backlog
+                elif self.telemetry is not None:
+                    backlog = self.ser.inWaiting()
+                filled = 0
+                while filled < want and self.running:
+                    n = readinto(self.ser, view[filled:want], self.timeout)
+                    filled += n
+                    if n:
+                        last_data = time.perf_counter()
+                    self.check_stall(n, last_data)
+                if filled == 0:
+                    self.free.put(block)
+                    continue
+                self.bytes_read += filled
+                t1 = time.perf_counter()
+                if self.telemetry is not None:
+                    self.telemetry.read(backlog, filled, t0, t1)
+                self.full.put((block, filled, t1))
+                self.max_queued = max(self.max_queued, self.full.qsize())
+        except Exception as err:
+            self.error = err
+        finally:
+            self.full.put(None)
+
+    #
+    # The device went quiet (e.g. it stopped itself after a buffer
+    # overflow): give up instead of waiting forever
+    #
+
+    def check_stall(self, n, last_data):
+        if n == 0 and time.perf_counter() - last_data > self.stall_timeout:
+            self.stalled = True
+            self.running = False
+
+    #
+    # Consumer thread: decode blocks and fan them out to the sinks
+    #
+
+    def consumer(self):
+        try:
+            while True:
+                item = self.full.get()
+                if item is None:
+                    break
+                # block_time is when the block's last byte was read
+                block, n, self.block_time = item
+                # After an error keep draining, so the reader never
+                # blocks on a dead consumer
+                if self.error is None:
+                    try:
+                        t0 = time.perf_counter()
+                        samples = self.decode(memoryview(block)[:n])
+                        self.dispatch(samples)
+                        if self.telemetry is not None:
+                            self.telemetry.block(self.block_time,
+                                                 len(samples), t0,
+                                                 time.perf_counter())
+                    except Exception as err:
+                        self.error = err
+                        self.running = False
+                self.free.put(block)
+        finally:
+            for sink in self.sinks:
+                sink.close()
+
+    def decode(self, data):
+        return self.decoder.decode(data)
+
+    def dispatch(self, samples):
+        if len(samples) == 0:
+            return
+        for sink in self.sinks:
+            sink.write(samples)
+        self.scans += len(samples)
+        self.blocks += 1
+
+    #
+    # Summary of the run
+    #
+    # Returns a dictionary
+    #
+
+    def report(self):
+        return {'bytes_read': self.bytes_read,
+                'scans': self.scans,
+                'blocks': self.blocks,
+                'overruns': self.overruns,
+                'max_queued': self.max_queued,
+                'wait_time': self.wait_time,
+                'misaligned': self.decoder.misaligned,
+                'skipped_bytes': self.decoder.skipped_bytes,
+                'stalled': self.stalled,
+                'policy': self.policy.report() if self.policy else None,
+                'telemetry': self.telemetry.snapshot()
+                             if self.telemetry else None}
+
+#
+# Sinks
+#
+
+#
+# Keeps the whole capture in one preallocated (Max_Samples, nchan) array
+#
+
+class capture:
+    def __init__(self, Max_Samples, nchan):
+        ''' Constructor for this class '''
+        self.samples = np.zeros((Max_Samples, nchan), dtype=np.int16)
+        self.nscans = 0
+
+    def write(self, samples):
+        n = min(len(samples), len(self.samples) - self.nscans)
+        self.samples[self.nscans:self.nscans + n] = samples[:n]
+        self.nscans += n
+
+    def close(self):
+        pass
+
+#
+# Writes raw little-endian int16 scans to a file
+#
+
+class raw_file:
+    def __init__(self, filename):
+        ''' Constructor for this class '''
+        self.filename = filename
+        self.f = open(filename, 'wb')
+
+    def write(self, samples):
+        self.f.write(samples.astype('<i2', copy=False).tobytes())
+
+    def close(self):
+        self.f.close()
+
+#
+# Running per-channel statistics
+#
+
+class stats:
+    def __init__(self, nchan):
+        ''' Constructor for this class '''
+        self.count = 0
+        self.minimum = np.full(nchan, np.iinfo(np.int16).max, dtype=np.int64)
+        self.maximum = np.full(nchan, np.iinfo(np.int16).min, dtype=np.int64)
+        self.total = np.zeros(nchan, dtype=np.float64)
+        self.total_sq = np.zeros(nchan, dtype=np.float64)
+
+    def write(self, samples):
+        self.count += len(samples)
+        self.minimum = np.minimum(self.minimum, samples.min(axis=0))
+        self.maximum = np.maximum(self.maximum, samples.max(axis=0))
+        x = samples.astype(np.float64)
+        self.total += x.sum(axis=0)
+        self.total_sq += (x * x).sum(axis=0)
+
+    def close(self):
+        pass
+
+    def mean(self):
+        return self.total / max(self.count, 1)
+
+    def rms(self):
+        return np.sqrt(self.total_sq / max(self.count, 1))
+
+#
+# Passes every block on to several sinks
+#
+
+class tee:
+    def __init__(self, *sinks):
+        ''' Constructor for this class '''
+        self.sinks = list(sinks)
+
+    def write(self, samples):
+        for sink in self.sinks:
+            sink.write(samples)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
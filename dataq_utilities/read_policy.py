@@ -0,0 +1,100 @@
+#
+# Adaptive read sizing for the acquisition pipeline.
+#
+# Instead of waiting for a fixed 32-scan block, the reader sleeps for an
+# interval, then drains whatever the link has buffered, rounded down to
+# whole scans.  Blocks are sized to hold max_latency seconds of data, so
+# a live consumer never sees data older than that.
+#
+# The interval adapts to the observed backlog:
+#   - a read that fills most of a block means data is arriving faster
+#     than the interval allows: halve it (read sooner, before the device
+#     buffer fills up);
+#   - the backlog can never exceed what the link itself buffers (4095
+#     bytes for a Linux tty), and once that is full the device holds the
+#     rest in its 1024-sample FIFO and soon overflows; so "most of a
+#     block" is measured against min(block, link_bytes), with link_bytes
+#     half the tty buffer to leave room for scheduling jitter;
+#   - a read that fills less than half a block means there is slack:
+#     lengthen it by a quarter, up to max_latency (fewer syscalls at low
+#     rates).
+#
+
+import select
+import time
+
+class adaptive_read:
+    def __init__(self, scan_bytes, Fs, max_latency=0.05,
+                 min_interval=0.0005, max_block_scans=65536,
+                 link_bytes=2048):
+        ''' Constructor for this class '''
+        self.scan_bytes = scan_bytes
+        self.Fs = Fs
+        self.max_latency = max_latency
+        self.min_interval = min_interval
+
+        # A block holds max_latency seconds of scans (at least 16)
+        block_scans = min(max(int(Fs * max_latency), 16), max_block_scans)
+        self.block_bytes = block_scans * scan_bytes
+        self.interval = max(min_interval, min(max_latency,
+                                              32 / float(Fs)))
+        # Largest backlog we let build up on the link
+        self.link_bytes = max(min(self.block_bytes, link_bytes),
+                              16 * scan_bytes)
+
+        self.backlog = 0
+        self.reads = 0
+        self.bytes = 0
+        self.grow = 0
+        self.shrink = 0
+
+    #
+    # Wait for data, then work out how much to read
+    #
+    # Returns a byte count: whole scans, at most want (0: nothing yet)
+    #
+
+    def wait(self, ser, want, timeout):
+        time.sleep(self.interval)
+        backlog = ser.inWaiting()
+        if backlog < self.scan_bytes:
+            # Nothing arrived while sleeping; block until something does
+            fd = getattr(ser, 'fd', None)
+            if fd is not None:
+                select.select([fd], [], [], timeout)
+            else:
+                time.sleep(min(timeout, self.max_latency))
+            backlog = ser.inWaiting()
+        n = min(backlog - backlog % self.scan_bytes, want)
+        self.update(n, backlog)
+        return n
+
+    #
+    # Adjust the interval from the size of the last read
+    #
+
+    def update(self, n, backlog):
+        self.reads += 1
+        self.bytes += n
+        self.backlog = backlog
+        if backlog >= 0.75 * self.link_bytes:
+            self.interval = max(self.min_interval, self.interval / 2)
+            self.shrink += 1
+        elif backlog < 0.5 * self.link_bytes:
+            self.interval = min(self.max_latency, self.interval * 1.25)
+            self.grow += 1
+
+    #
+    # Summary of the policy's behaviour
+    #
+    # Returns a dictionary
+    #
+
+    def report(self):
+        return {'reads': self.reads,
+                'mean_read_bytes': self.bytes / max(self.reads, 1),
+                'interval': self.interval,
+                'block_bytes': self.block_bytes,
+                'link_bytes': self.link_bytes,
+                'interval_shrinks': self.shrink,
+                'interval_grows': self.grow}
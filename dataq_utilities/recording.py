@@ -0,0 +1,181 @@
+#
+# Memory-mapped reader for recordings.
+#
+# The data chunk of a WAV file (RIFF or RF64, as written by wav_writer) is
+# memory-mapped as an (nscans, nchan) int16 array, so opening a multi-GB
+# recording costs nothing until samples are touched, and per-channel
+# arrays are strided views rather than copies.
+#
+# chunks() walks the recording block by block and converts each block to
+# float32 volts: 10/32768 V per count, with the digital input bits (bits
+# 0-1 of scan position 0, see decoder.py) masked off first (0xFFFC).  An
+# analysis that consumes chunks runs in memory bounded by the chunk size.
+#
+# read(t0, t1) returns just the scans of a time window: the scan index
+# follows from the rate in the header, so only those frames are paged in
+# and a few seconds out of a multi-GB file take milliseconds.
+#
+# A .part file that is still being written can be read too: its header
+# has no data size yet, so the size of the file is used.
+#
+
+import os
+import struct
+import numpy as np
+
+SCALE = 10 / 32768
+MASK = 0xFFFC
+
+#
+# Convert an int16 block to float32 volts
+#
+# positions are the scan list positions of the block's columns (default:
+# 0, 1, ...); the digital bits are masked off scan position 0
+#
+# Returns an (n, ncol) float32 array
+#
+
+def to_volts(block, positions=None, mask=True):
+    if positions is None:
+        positions = range(block.shape[1])
+    out = np.empty(block.shape, dtype=np.float32)
+    np.multiply(block, np.float32(SCALE), out=out)
+    if mask and 0 in positions:
+        col = list(positions).index(0)
+        masked = np.bitwise_and(block[:, col], np.int16(MASK - 0x10000))
+        np.multiply(masked, np.float32(SCALE), out=out[:, col])
+    return out
+
+class recording:
+    def __init__(self, filename):
+        ''' Constructor for this class '''
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.parse_header(f)
+        file_bytes = os.path.getsize(filename)
+        available = file_bytes - self.offset
+        if self.data_bytes in (0, 0xFFFFFFFF) or \
+           self.data_bytes > available:
+            # Still being written (or truncated): use what is there
+            self.data_bytes = available
+        self.nscans = self.data_bytes // self.frame_bytes
+        if self.nscans > 0:
+            self.data = np.memmap(filename, dtype='<i2', mode='r',
+                                  offset=self.offset,
+                                  shape=(self.nscans, self.nchan))
+        else:
+            self.data = np.zeros((0, self.nchan), dtype='<i2')
+        self.duration = self.nscans / float(self.rate)
+
+    #
+    # Find the fmt and data chunks (and ds64 for RF64 files)
+    #
+
+    def parse_header(self, f):
+        head = f.read(12)
+        if len(head) < 12:
+            raise ValueError('{}: not a WAV file'.format(self.filename))
+        riff, size, wave = struct.unpack('<4sI4s', head)
+        if riff not in (b'RIFF', b'RF64') or wave != b'WAVE':
+            raise ValueError('{}: not a WAV file'.format(self.filename))
+        ds64_data = None
+        self.rate = None
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                raise ValueError('{}: no data chunk'.format(self.filename))
+            chunk, size = struct.unpack('<4sI', head)
+            if chunk == b'ds64':
+                riff_size, ds64_data = struct.unpack('<QQ', f.read(16))
+                f.seek(size - 16 + (size & 1), 1)
+            elif chunk == b'fmt ':
+                fmt = f.read(size)
+                (tag, self.nchan, self.rate, byte_rate, self.frame_bytes,
+                 bits) = struct.unpack('<HHIIHH', fmt[:16])
+                if bits != 16:
+                    raise ValueError('{}: {} bit samples, expected 16'
+                                     .format(self.filename, bits))
+                if size & 1:
+                    f.seek(1, 1)
+            elif chunk == b'data':
+                if self.rate is None:
+                    raise ValueError('{}: data before fmt chunk'
+                                     .format(self.filename))
+                self.offset = f.tell()
+                if size == 0xFFFFFFFF and ds64_data is not None:
+                    size = ds64_data
+                self.data_bytes = size
+                return
+            else:
+                f.seek(size + (size & 1), 1)
+
+    def close(self):
+        # Drop the mapping; views handed out keep it alive until released
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.nscans
+
+    #
+    # Raw int16 samples of one scan list position (a strided view)
+    #
+
+    def channel(self, n):
+        return self.data[:, n]
+
+    #
+    # Scan index of time t (seconds from the start), clipped to the file
+    #
+
+    def scan(self, t):
+        return min(max(int(round(t * self.rate)), 0), self.nscans)
+
+    #
+    # Samples from t0 to t1 seconds (default: to the end)
+    #
+    # channels selects scan list positions (default: all)
+    #
+    # Returns an (n, ncol) float32 array of volts, or an int16 copy of the
+    # file's samples with raw=True
+    #
+
+    def read(self, t0=0, t1=None, channels=None, raw=False, mask=True):
+        first = self.scan(t0)
+        last = self.nscans if t1 is None else max(self.scan(t1), first)
+        block = self.data[first:last]
+        positions = list(range(self.nchan)) if channels is None \
+            else list(channels)
+        if channels is not None:
+            block = block[:, positions]
+        if raw:
+            return np.array(block)
+        return to_volts(block, positions, mask)
+
+    #
+    # Iterate over the recording in blocks of chunk_scans scans
+    #
+    # channels selects scan list positions (default: all).  Yields
+    # (first scan, block) pairs; blocks are float32 volts, or int16 views
+    # of the file with raw=True
+    #
+
+    def chunks(self, chunk_scans=65536, channels=None, start=0, stop=None,
+               raw=False, mask=True):
+        positions = list(range(self.nchan)) if channels is None \
+            else list(channels)
+        if stop is None or stop > self.nscans:
+            stop = self.nscans
+        for first in range(max(start, 0), stop, chunk_scans):
+            block = self.data[first:min(first + chunk_scans, stop)]
+            if channels is not None:
+                block = block[:, positions]
+            if raw:
+                yield first, block
+            else:
+                yield first, to_volts(block, positions, mask)
@@ -9,15 +9,21 @@
 import serial.tools.list_ports
 import serial
 import time
+import select
 import usb.core
 
 class dataq:
     def __init__(self):
         ''' Constructor for this class '''
         self.functions = ['discover_device',
+                         'discover_devices',
                          'config_scan_list',
                          'send_command',
-                         'find_device']
+                         'configure',
+                         'find_device',
+                         'sampling_rate']
+        self.timings = []
+        self.configure_time = 0
 
     def show(self):
         print('DataQ serial commands')
@@ -50,6 +56,20 @@ class dataq:
                 return(hooked_port)
                 break
 
+    #
+    # Discover every DATAQ Instruments device, not just the first one
+    #
+    # Returns a list of port names, sorted so the order is stable
+    #
+
+    def discover_devices(self):
+        available_ports = list(serial.tools.list_ports.comports())
+        hooked_ports = []
+        for p in available_ports:
+            if ("VID:PID=0683" in p.hwid):
+                hooked_ports.append(p.device)
+        return sorted(hooked_ports)
+
     #
     # Tweaked version of "config_scn_lst()"
     # From DI-1100-serial
@@ -69,29 +89,109 @@ class dataq:
     # Tweaked version of "send_cmd()"
     # From DI-1100-serial
     #
-    # Returns values from serial port
+    # Waits for the command's echo (not a fixed delay) until the deadline.
+    # Binary scan data still in flight ahead of the echo, e.g. before the
+    # "stop" echo, is discarded.  The round-trip time of each command is
+    # kept in self.timings.
+    #
+    # Returns the echo string (None if acquiring or if no echo arrived)
     #
 
-    def send_command(self, ser, command, acquiring):
+    def send_command(self, ser, command, acquiring, timeout=1.0,
+                     verbose=True):
+        t0 = time.perf_counter()
         ser.write((command+'\r').encode())
-        time.sleep(.1)
-        if not(acquiring):
-            # Echo commands if not acquiring
-            while True:
-                if(ser.inWaiting() > 0):
-                    while True:
-                        try:
-                            s = ser.readline().decode()
-                            s = s.strip('\n')
-                            s = s.strip('\r')
-                            s = s.strip(chr(0))
-                            break
-                        except:
-                            continue
-                    # This "if" is at the level of the "while"
-                    if s != "":
-                        print('Cmd / Echo: {} / {}'.format(command, s))
+        if acquiring:
+            return None
+        # Echo commands if not acquiring
+        s = dataq.read_echo(self, ser, command.split()[0], t0 + timeout)
+        rtt = time.perf_counter() - t0
+        self.timings.append((command, rtt))
+        if verbose:
+            if s is None:
+                print('Cmd / Echo: {} / (no echo after {:.3f} s)'
+                      .format(command, rtt))
+            else:
+                print('Cmd / Echo: {} / {}'.format(command, s))
+        return s
+
+    #
+    # Read lines from the port until one starts with the given word
+    #
+    # Returns a string, or None at the deadline
+    #
+
+    def read_echo(self, ser, word, deadline):
+        fd = getattr(ser, 'fd', None)
+        pending = bytearray()
+        key = word.encode()
+        while True:
+            n = ser.inWaiting()
+            if n > 0:
+                pending += ser.read(n)
+                # Replies end with a carriage return
+                while True:
+                    end = pending.find(b'\r')
+                    if end < 0:
                         break
+                    line = bytes(pending[:end])
+                    del pending[:end + 1]
+                    start = line.rfind(key)
+                    if start >= 0:
+                        s = line[start:].decode(errors='ignore')
+                        return s.strip('\n').strip(chr(0))
+                continue
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            if fd is not None:
+                select.select([fd], [], [], remaining)
+            else:
+                time.sleep(min(remaining, 0.001))
+
+    #
+    # Sends the whole setup sequence and checks every echo
+    #
+    # stop, encode, ps, dec, deca, filter (per channel), slist, srate
+    #
+    # Returns actual sampling rate, raises RuntimeError if the device
+    # does not echo a command
+    #
+
+    def configure(self, ser, slist, desired_rate, decimation_factor=1,
+                  filter_mode=0, dec=1, deca=1, packet_size=0, timeout=1.0,
+                  verbose=False):
+        self.timings = []
+        t0 = time.perf_counter()
+        setup = ['stop',
+                 'encode 0',
+                 'ps {}'.format(packet_size),
+                 'dec {}'.format(dec),
+                 'deca {}'.format(deca)]
+        for item in sorted(set(slist)):
+            setup.append('filter {} {}'.format(item, filter_mode))
+        for position, item in enumerate(slist):
+            setup.append('slist {} {}'.format(position, item))
+        srate_value = int(60000000 / desired_rate / decimation_factor)
+        setup.append('srate {}'.format(srate_value))
+
+        failed = []
+        for command in setup:
+            s = dataq.send_command(self, ser, command, False, timeout,
+                                   verbose)
+            if s is None or s.split()[:len(command.split())] != \
+                    command.split():
+                failed.append((command, s))
+            if command == 'stop':
+                # Anything still buffered belongs to an earlier scan
+                ser.reset_input_buffer()
+        self.configure_time = time.perf_counter() - t0
+        if failed:
+            raise RuntimeError('DataQ device did not echo: {}'
+                               .format(failed))
+
+        Fs = int(60000000 / srate_value / decimation_factor)
+        return Fs
 
     #
     # Tweaked version of the original "findProdPort()"
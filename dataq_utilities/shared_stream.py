@@ -0,0 +1,227 @@
+#
+# Live stream of decoded scans in shared memory.
+#
+# stream_publisher is a pipeline sink that copies every block of scans
+# into a ring buffer in a multiprocessing.shared_memory segment, then
+# advances a write sequence number (the number of scans ever written).
+# Any number of local processes attach a stream_reader by name.  Each
+# reader keeps its own cursor (a sequence number) in its own process, so
+# there are no locks, the publisher never waits for a reader, and a
+# reader gets numpy views straight into the ring (no copies).
+#
+# A reader that falls more than the ring's capacity behind has been
+# lapped: the scans it missed are gone.  read() then skips to the oldest
+# scan still in the ring and reports how many were missed.  A view
+# handed out can also be overwritten while it is being used by a slow
+# reader; intact(first) tells whether it still holds what was read.
+#
+# Segment layout: HEADER_BYTES of int64 header fields (see below), then
+# a (capacity, nchan) int16 ring; scan number s is at row s % capacity.
+# The sequence number is a single aligned 8-byte store, written after
+# the scans it covers; before copying a block the publisher stores where
+# it will end, so readers know which rows are being overwritten.
+#
+#     publisher:  acq.add_sink(stream_publisher('dataq', nchan, Fs))
+#     reader:     stream = stream_reader('dataq')
+#                 for first, block, missed in stream:
+#                     ...
+#
+
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+MAGIC = 0x44515354     # 'DQST'
+HEADER_BYTES = 64
+# Header fields (int64)
+H_MAGIC, H_NCHAN, H_CAPACITY, H_RATE, H_SEQUENCE, H_CLOSED, H_WRITING = \
+    range(7)
+
+#
+# Attach to an existing segment without handing it to this process's
+# resource tracker (which would unlink it when the reader exits)
+#
+
+def attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class stream_publisher:
+    def __init__(self, name, nchan, rate, capacity=2**20):
+        ''' Constructor for this class '''
+        self.name = name
+        self.nchan = nchan
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(
+            name, create=True, size=HEADER_BYTES + 2 * nchan * capacity)
+        self.header = np.ndarray(HEADER_BYTES // 8, np.int64,
+                                 buffer=self.shm.buf)
+        self.ring = np.ndarray((capacity, nchan), np.int16,
+                               buffer=self.shm.buf, offset=HEADER_BYTES)
+        self.header[:] = 0
+        self.header[H_NCHAN] = nchan
+        self.header[H_CAPACITY] = capacity
+        self.header[H_RATE] = int(round(rate))
+        self.header[H_MAGIC] = MAGIC
+        self.sequence = 0
+
+    #
+    # Sink interface
+    #
+
+    def write(self, samples):
+        n = len(samples)
+        if n == 0 or self.header is None:
+            return
+        first = self.sequence
+        if n > self.capacity:
+            # Only the last capacity scans can be kept
+            samples = samples[n - self.capacity:]
+            first += n - self.capacity
+        # Rows up to scan sequence + n are about to be overwritten
+        self.header[H_WRITING] = self.sequence + n
+        pos = first % self.capacity
+        part = min(len(samples), self.capacity - pos)
+        self.ring[pos:pos + part] = samples[:part]
+        self.ring[:len(samples) - part] = samples[part:]
+        # Publish only once the scans are in place
+        self.sequence += n
+        self.header[H_SEQUENCE] = self.sequence
+
+    #
+    # Mark the stream finished; readers drain what is left.  The segment
+    # name is removed (unlink), attached readers keep their mapping.
+    #
+
+    def close(self, unlink=True):
+        if self.header is None:
+            return
+        self.header[H_CLOSED] = 1
+        self.header = None
+        self.ring = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+        if unlink:
+            self.shm.unlink()
+
+
+class stream_reader:
+    def __init__(self, name, from_start=False):
+        ''' Constructor for this class '''
+        self.shm = attach(name)
+        self.header = np.ndarray(HEADER_BYTES // 8, np.int64,
+                                 buffer=self.shm.buf)
+        if self.header[H_MAGIC] != MAGIC:
+            self.close()
+            raise ValueError('{}: not a DataQ stream'.format(name))
+        self.nchan = int(self.header[H_NCHAN])
+        self.capacity = int(self.header[H_CAPACITY])
+        self.rate = int(self.header[H_RATE])
+        self.ring = np.ndarray((self.capacity, self.nchan), np.int16,
+                               buffer=self.shm.buf, offset=HEADER_BYTES)
+        self.ring.flags.writeable = False
+        sequence = int(self.header[H_SEQUENCE])
+        # Live by default, or from the oldest scan still in the ring
+        self.cursor = min(self.oldest(), sequence) if from_start \
+            else sequence
+        self.missed = 0
+        self.laps = 0
+
+    @property
+    def sequence(self):
+        return int(self.header[H_SEQUENCE])
+
+    @property
+    def closed(self):
+        return bool(self.header[H_CLOSED])
+
+    #
+    # Oldest scan that is safe to read (not being overwritten)
+    #
+
+    def oldest(self):
+        return max(int(self.header[H_WRITING]) - self.capacity, 0)
+
+    def available(self):
+        return self.sequence - self.cursor
+
+    #
+    # Next scans, up to max_scans (default: all that are contiguous in
+    # the ring)
+    #
+    # Returns (first, block, missed): the sequence number of the first
+    # scan, a read-only (n, nchan) int16 view into the ring (n may be 0)
+    # and the number of scans lost to lapping just before it
+    #
+
+    def read(self, max_scans=None):
+        sequence = self.sequence
+        missed = 0
+        oldest = self.oldest()
+        if self.cursor < oldest:
+            missed = oldest - self.cursor
+            self.cursor = oldest
+            self.missed += missed
+            self.laps += 1
+        pos = self.cursor % self.capacity
+        n = min(max(sequence - self.cursor, 0), self.capacity - pos)
+        if max_scans is not None:
+            n = min(n, max_scans)
+        first = self.cursor
+        self.cursor += n
+        return first, self.ring[pos:pos + n], missed
+
+    #
+    # Whether scans from first on (as returned by read) are still in the
+    # ring, i.e. a view of them has not been (or is not being) overwritten
+    #
+
+    def intact(self, first):
+        return self.oldest() <= first
+
+    #
+    # Wait up to timeout seconds for new scans
+    #
+    # Returns True if there are any
+    #
+
+    def wait(self, timeout=None, poll=0.001):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.available() == 0:
+            if self.closed or (deadline is not None and
+                               time.monotonic() >= deadline):
+                return self.available() > 0
+            time.sleep(poll)
+        return True
+
+    #
+    # Blocks of scans as they arrive, until the publisher closes
+    #
+
+    def __iter__(self):
+        while self.wait():
+            first, block, missed = self.read()
+            if len(block):
+                yield first, block, missed
+
+    def close(self):
+        # Views handed out keep the mapping alive until released
+        self.ring = None
+        self.header = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
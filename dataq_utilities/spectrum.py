@@ -0,0 +1,283 @@
+#
+# Batched multichannel spectrum.
+#
+# All channels of an (n, nchan) array go through one real FFT along the
+# time axis (scipy.fft.rfft, multithreaded with workers), so only the
+# n/2 + 1 non-negative frequencies are ever computed.  Magnitudes are
+# converted to dB in place, in the real parts of the FFT output, so there
+# is no complex copy and no full-size float temporary.
+#
+# FFT length policies (n samples, zeropad multiplier z, 0 counts as 1):
+#   'pow2': z * 2**ceil(log2(n))  (Processing.py's original spectrum is
+#           'pow2' with z = 4)
+#   'fast': the next length >= z * n that scipy's FFT handles quickly
+#           (only factors 2, 3, 5, ...), usually much shorter
+#
+# For fine resolution in a narrow band, zoom evaluates the same transform
+# at nbins frequencies from fmin to fmax only, with a chirp-z transform.
+# Bin spacing is then (fmax - fmin) / (nbins - 1) at the cost of one
+# transform of about n + nbins points, where zero padding to the same
+# spacing would need rate / spacing points for the whole band.  The
+# transform is linear, so it is accumulated chunk by chunk (each chunk's
+# CZT shifted by its start time) and memory does not grow with the
+# record.  Values are on the same scale as spectrum().
+#
+# welch accumulates a Welch-averaged PSD the same way: windowed segment
+# power is summed per channel as blocks arrive (the segment overlap is
+# carried between blocks), and result() is available at any point.
+# Accumulators with the same parameters can be merged, e.g. one per file
+# of a night's recordings, and saved to / loaded from .npz files.
+#
+
+import numpy as np
+from scipy import fft, signal
+
+from dataq_utilities.recording import to_volts
+
+PADDING = ['pow2', 'fast']
+
+#
+# FFT length for n samples
+#
+# Returns an int
+#
+
+def fft_length(n, zeropad=4, padding='pow2'):
+    z = max(zeropad, 1)
+    if padding == 'pow2':
+        return z * 2 ** int(np.ceil(np.log2(max(n, 1))))
+    if padding == 'fast':
+        return fft.next_fast_len(z * n, real=True)
+    raise ValueError('padding must be one of {}'.format(PADDING))
+
+#
+# Magnitude spectrum of every channel
+#
+# data is (n, nchan) (or (n,) for one channel); float32 data is
+# transformed in single precision.  The Nyquist bin is dropped, as in the
+# original spectrum().
+#
+# Returns (Y, F): Y is (nfft//2, nchan), 20*log10|FFT| with db=True (a
+# strided view into the FFT output), F the frequencies in Hz
+#
+
+def spectrum(data, rate, zeropad=4, padding='pow2', workers=-1, db=True):
+    data = np.asarray(data)
+    if data.dtype not in (np.float32, np.float64):
+        data = data.astype(np.float64)
+    nfft = fft_length(len(data), zeropad, padding)
+    Y = fft.rfft(data, n=nfft, axis=0, workers=workers)[:nfft // 2]
+
+    # |Y| written over the real parts, then dB in place
+    parts = Y.view(Y.real.dtype).reshape(Y.shape + (2,))
+    mag = parts[..., 0]
+    np.hypot(mag, parts[..., 1], out=mag)
+    if db:
+        np.log10(mag, out=mag)
+        mag *= 20
+    F = fft.rfftfreq(nfft, 1 / float(rate))[:nfft // 2]
+    return mag, F
+
+#
+# Band-limited high resolution spectrum, accumulated over sample blocks
+#
+
+class zoom:
+    def __init__(self, rate, fmin, fmax, nbins):
+        ''' Constructor for this class '''
+        if not 0 <= fmin < fmax <= rate / 2.0 or nbins < 2:
+            raise ValueError('need 0 <= fmin < fmax <= rate/2 and nbins > 1')
+        self.rate = rate
+        self.F = np.linspace(fmin, fmax, nbins)
+        self.w = np.exp(-2j * np.pi * (fmax - fmin) / ((nbins - 1) * rate))
+        self.a = np.exp(2j * np.pi * fmin / rate)
+        self.transforms = {}
+        self.X = None
+        self.scans = 0
+
+    #
+    # Add an (n, nchan) (or (n,)) block that follows the previous one
+    #
+
+    def feed(self, block):
+        n = len(block)
+        if n == 0:
+            return
+        if n not in self.transforms:
+            # Planned once per block length (all but the last are equal)
+            self.transforms[n] = signal.CZT(n, len(self.F), self.w, self.a)
+        X = self.transforms[n](np.asarray(block), axis=0)
+        # Shift by the block's start time; the product is taken modulo
+        # one cycle to keep the phase accurate for long records
+        cycles = np.mod(self.F * (self.scans / float(self.rate)), 1.0)
+        shift = np.exp(-2j * np.pi * cycles)
+        X *= shift.reshape((-1,) + (1,) * (X.ndim - 1))
+        if self.X is None:
+            self.X = X
+        else:
+            self.X += X
+        self.scans += n
+
+    #
+    # Run over a recording
+    #
+
+    def run(self, rec, chunk_scans=65536, channels=None, start=0, stop=None):
+        for first, block in rec.chunks(chunk_scans, channels, start, stop):
+            self.feed(block)
+        return self.result()
+
+    #
+    # Returns (Y, F): Y is (nbins, nchan), 20*log10|X| with db=True
+    #
+
+    def result(self, db=True):
+        Y = np.abs(self.X)
+        if db:
+            Y = 20 * np.log10(Y)
+        return Y, self.F
+
+#
+# Zoom spectrum of an (n, nchan) array in one call
+#
+# Returns (Y, F) as zoom.result()
+#
+
+def zoom_spectrum(data, rate, fmin, fmax, nbins, db=True,
+                  chunk_scans=None):
+    z = zoom(rate, fmin, fmax, nbins)
+    data = np.asarray(data)
+    step = len(data) if chunk_scans is None else chunk_scans
+    for first in range(0, len(data), max(step, 1)):
+        z.feed(data[first:first + step])
+    return z.result(db)
+
+#
+# Streaming Welch PSD with mergeable per-channel accumulators
+#
+# Matches scipy.signal.welch(x, fs, window, nperseg, noverlap, nfft,
+# detrend, return_onesided=True, scaling, average='mean') on the whole
+# record
+#
+
+class welch:
+    def __init__(self, fs, nchan, window='hann', nperseg=1024, noverlap=None,
+                 nfft=None, detrend='constant', scaling='density',
+                 workers=None):
+        ''' Constructor for this class '''
+        if noverlap is None:
+            noverlap = nperseg // 2
+        if not 0 <= noverlap < nperseg:
+            raise ValueError('noverlap must be less than nperseg')
+        if detrend not in ('constant', False):
+            raise ValueError("detrend must be 'constant' or False")
+        self.fs = fs
+        self.nchan = nchan
+        self.params = (window, nperseg, noverlap,
+                       nperseg if nfft is None else max(nfft, nperseg),
+                       detrend, scaling)
+        self.nperseg = nperseg
+        self.step = nperseg - noverlap
+        self.nfft = self.params[3]
+        self.detrend = detrend
+        self.workers = workers
+
+        win = signal.get_window(window, nperseg)
+        self.window = win.astype(np.float32)
+        if scaling == 'density':
+            self.scale = 1.0 / (fs * (win * win).sum())
+        elif scaling == 'spectrum':
+            self.scale = 1.0 / win.sum() ** 2
+        else:
+            raise ValueError("scaling must be 'density' or 'spectrum'")
+        self.frequencies = fft.rfftfreq(self.nfft, 1 / float(fs))
+
+        self.power = np.zeros((len(self.frequencies), nchan))
+        self.segments = 0
+        self.carry = np.zeros((0, nchan), dtype=np.float32)
+
+    #
+    # Add an (n, nchan) block that follows the previous one
+    #
+
+    def feed(self, block):
+        x = np.concatenate((self.carry, np.asarray(block, np.float32)))
+        nseg = 0
+        if len(x) >= self.nperseg:
+            nseg = (len(x) - self.nperseg) // self.step + 1
+        if nseg > 0:
+            # (nseg, nchan, nperseg) segments
+            segments = np.lib.stride_tricks.sliding_window_view(
+                x, self.nperseg, axis=0)[::self.step][:nseg]
+            if self.detrend == 'constant':
+                segments = segments - segments.mean(axis=-1, keepdims=True)
+            spec = fft.rfft(segments * self.window, n=self.nfft, axis=-1,
+                            workers=self.workers)
+            self.power += (spec.real ** 2 + spec.imag ** 2).sum(axis=0).T
+            self.segments += nseg
+        self.carry = x[nseg * self.step:].copy()
+
+    def run(self, rec, chunk_scans=65536, channels=None, start=0, stop=None):
+        for first, block in rec.chunks(chunk_scans, channels, start, stop):
+            self.feed(block)
+        return self.result()
+
+    #
+    # Sink interface: int16 blocks from a pipeline are converted to volts
+    #
+
+    def write(self, samples):
+        if samples.dtype == np.int16:
+            samples = to_volts(samples)
+        self.feed(samples)
+
+    def close(self):
+        pass
+
+    #
+    # Add the segments of another accumulator (same parameters)
+    #
+
+    def merge(self, other):
+        if (other.fs, other.nchan, other.params) != \
+           (self.fs, self.nchan, self.params):
+            raise ValueError('cannot merge Welch accumulators with '
+                             'different parameters')
+        self.power += other.power
+        self.segments += other.segments
+        return self
+
+    #
+    # PSD so far
+    #
+    # Returns (Pxx, F): Pxx is (nfreq, nchan), V**2/Hz for 'density'
+    #
+
+    def result(self):
+        Pxx = self.power * (self.scale / max(self.segments, 1))
+        # One-sided: double everything but DC (and Nyquist for even nfft)
+        if self.nfft % 2:
+            Pxx[1:] *= 2
+        else:
+            Pxx[1:-1] *= 2
+        return Pxx, self.frequencies
+
+    def save(self, filename):
+        window, nperseg, noverlap, nfft, detrend, scaling = self.params
+        np.savez(filename, power=self.power, segments=self.segments,
+                 fs=self.fs, window=str(window), nperseg=nperseg,
+                 noverlap=noverlap, nfft=nfft, detrend=str(detrend),
+                 scaling=scaling)
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as f:
+            detrend = str(f['detrend'])
+            acc = welch(float(f['fs']), f['power'].shape[1],
+                        str(f['window']), int(f['nperseg']),
+                        int(f['noverlap']), int(f['nfft']),
+                        False if detrend == 'False' else detrend,
+                        str(f['scaling']))
+            acc.power = f['power'].copy()
+            acc.segments = int(f['segments'])
+        return acc
@@ -0,0 +1,155 @@
+#
+# Streaming STFT / spectrogram engine.
+#
+# Sample blocks go in (from recording.chunks() or, as a pipeline sink,
+# straight from an acquisition), spectrogram columns come out.  The last
+# nperseg - step samples of every block are carried over to the next, so
+# the columns are exactly those of one scipy.signal.spectrogram() call on
+# the whole record with
+#
+#     window, nperseg, noverlap, nfft, detrend=False,
+#     return_onesided=True, mode='magnitude', scaling='spectrum'
+#
+# i.e. |rfft(segment * window, nfft)| / sum(window), for every channel at
+# once.  Memory is bounded by the block size, whatever the record length.
+#
+# Columns can be handed to a spectrogram_writer, which appends them to a
+# .npy file as they are produced; np.load(..., mmap_mode='r') reads it
+# back without loading it.
+#
+
+import struct
+import numpy as np
+from scipy import fft, signal
+
+from dataq_utilities.recording import to_volts
+
+class stft:
+    def __init__(self, fs, nchan, window='hann', nperseg=1024, noverlap=None,
+                 nfft=None, db=False, output=None, workers=None):
+        ''' Constructor for this class '''
+        if noverlap is None:
+            noverlap = nperseg // 8
+        if not 0 <= noverlap < nperseg:
+            raise ValueError('noverlap must be less than nperseg')
+        self.fs = fs
+        self.nchan = nchan
+        self.nperseg = nperseg
+        self.noverlap = noverlap
+        self.step = nperseg - noverlap
+        self.nfft = nperseg if nfft is None else max(nfft, nperseg)
+        self.db = db
+        self.output = output
+        self.workers = workers
+
+        win = signal.get_window(window, nperseg)
+        self.window = (win / win.sum()).astype(np.float32)
+        self.frequencies = fft.rfftfreq(self.nfft, 1 / float(fs))
+        self.nfreq = len(self.frequencies)
+
+        self.carry = np.zeros((0, nchan), dtype=np.float32)
+        self.columns = 0
+
+    #
+    # Centre time of column k (seconds)
+    #
+
+    def time(self, k):
+        return (self.nperseg / 2 + k * self.step) / float(self.fs)
+
+    #
+    # Add an (n, nchan) block of samples
+    #
+    # Returns (times, columns): the new columns as an (ncol, nchan, nfreq)
+    # float32 array (magnitudes, or 10*log10 of them with db=True)
+    #
+
+    def feed(self, block):
+        x = np.concatenate((self.carry, np.asarray(block, np.float32)))
+        ncol = 0
+        if len(x) >= self.nperseg:
+            ncol = (len(x) - self.nperseg) // self.step + 1
+        if ncol == 0:
+            self.carry = x
+            return np.zeros(0), np.zeros((0, self.nchan, self.nfreq),
+                                         dtype=np.float32)
+
+        # (ncol, nchan, nperseg) windowed segments, then one batched rfft
+        segments = np.lib.stride_tricks.sliding_window_view(
+            x, self.nperseg, axis=0)[::self.step][:ncol]
+        spec = fft.rfft(segments * self.window, n=self.nfft, axis=-1,
+                        workers=self.workers)
+        columns = np.abs(spec).astype(np.float32)
+        if self.db:
+            np.log10(columns, out=columns)
+            columns *= 10
+
+        times = self.time(self.columns + np.arange(ncol))
+        self.columns += ncol
+        self.carry = x[ncol * self.step:].copy()
+        if self.output is not None:
+            self.output.write(columns)
+        return times, columns
+
+    #
+    # Run over a recording
+    #
+    # Returns the number of columns
+    #
+
+    def run(self, rec, chunk_scans=65536, channels=None, start=0, stop=None):
+        for first, block in rec.chunks(chunk_scans, channels, start, stop):
+            self.feed(block)
+        self.close()
+        return self.columns
+
+    #
+    # Sink interface: int16 blocks from a pipeline are converted to volts
+    #
+
+    def write(self, samples):
+        if samples.dtype == np.int16:
+            samples = to_volts(samples)
+        self.feed(samples)
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+
+#
+# Appends spectrogram columns to a .npy file
+#
+# The header reserves room for the final shape and is rewritten on close
+#
+
+class spectrogram_writer:
+    HEADER_BYTES = 128
+
+    def __init__(self, filename, nchan, nfreq):
+        ''' Constructor for this class '''
+        self.filename = filename
+        self.nchan = nchan
+        self.nfreq = nfreq
+        self.columns = 0
+        self.f = open(filename, 'wb')
+        self.f.write(self.header())
+
+    def header(self):
+        d = ("{{'descr': '<f4', 'fortran_order': False, "
+             "'shape': ({}, {}, {}), }}").format(self.columns, self.nchan,
+                                                 self.nfreq)
+        size = self.HEADER_BYTES - 10
+        h = d.encode().ljust(size - 1) + b'\n'
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', size) + h
+
+    def write(self, columns):
+        self.f.write(np.ascontiguousarray(columns, dtype='<f4'))
+        self.columns += len(columns)
+
+    def close(self):
+        if self.f is None:
+            return
+        self.f.seek(0)
+        self.f.write(self.header())
+        self.f.close()
+        self.f = None
@@ -0,0 +1,168 @@
+#
+# Acquisition telemetry.
+#
+# A telemetry object is handed to a pipeline (pipeline(..., telemetry=t))
+# and is updated by its reader and consumer threads:
+#
+#   - the inWaiting backlog seen at every read, as a histogram with
+#     power-of-two bins (bin k counts backlogs of 2**(k-1) .. 2**k - 1
+#     bytes, bin 0 an empty link) plus the maximum;
+#   - how long every read took (waiting + copying) and how long every
+#     block waited between being read and leaving the sinks, kept for the
+#     last `window` reads for percentiles;
+#   - overflows: reads that found the link buffer full (link_bytes, 4095
+#     bytes for a Linux tty, see read_policy.py) and came longer after
+#     the previous read than the link buffer plus the device's
+#     1024-sample FIFO can hold at this rate (buffer_time); data was
+#     probably dropped.  Long read intervals alone are not losses, the
+#     buffers cover them.  Bytes actually lost show up as decoder
+#     resyncs (misaligned scans), and a device that stopped after its
+#     FIFO overflowed as a stall;
+#   - effective versus configured Fs, scans, overruns and the decoder's
+#     misaligned / skipped byte counts.
+#
+# snapshot() may be called from any thread while the pipeline runs (live
+# polling); write_json() saves the snapshot at the end of a run.  A
+# pipeline without telemetry does none of this work.
+#
+
+import json
+import time
+import numpy as np
+
+FIFO_SAMPLES = 1024
+LINK_BYTES = 4095
+
+class telemetry:
+    def __init__(self, Fs, nchan, window=4096, bins=24,
+                 link_bytes=LINK_BYTES):
+        ''' Constructor for this class '''
+        self.Fs = Fs
+        self.nchan = nchan
+        self.window = window
+        self.link_bytes = link_bytes
+        self.buffer_time = (link_bytes + 2 * FIFO_SAMPLES) / \
+            float(2 * Fs * nchan)
+        self.pipeline = None
+
+        self.backlog_hist = [0] * bins
+        self.max_backlog = 0
+        self.read_times = np.zeros(window)
+        self.block_latencies = np.zeros(window)
+
+        self.reads = 0
+        self.blocks = 0
+        self.read_time = 0.0
+        self.busy_time = 0.0
+        self.overflows = 0
+        self.longest_gap = 0.0
+        self.last_read = None
+        self.first_time = None
+        self.first_scans = 0
+        self.last_time = None
+        self.scans = 0
+
+    #
+    # Reader thread: one read of nbytes, backlog bytes were waiting
+    #
+
+    def read(self, backlog, nbytes, t0, t1):
+        k = min(backlog.bit_length(), len(self.backlog_hist) - 1)
+        self.backlog_hist[k] += 1
+        if backlog > self.max_backlog:
+            self.max_backlog = backlog
+        self.read_times[self.reads % self.window] = t1 - t0
+        self.read_time += t1 - t0
+        if self.last_read is not None:
+            gap = t1 - self.last_read
+            if backlog >= self.link_bytes and gap > self.buffer_time:
+                self.overflows += 1
+            if gap > self.longest_gap:
+                self.longest_gap = gap
+        self.last_read = t1
+        self.reads += 1
+
+    #
+    # Consumer thread: a block read at block_time, with scans scans, was
+    # decoded and written to the sinks between t0 and t1
+    #
+
+    def block(self, block_time, scans, t0, t1):
+        self.block_latencies[self.blocks % self.window] = t1 - block_time
+        self.busy_time += t1 - t0
+        self.blocks += 1
+        if self.first_time is None:
+            # Time is counted from the end of the first block
+            self.first_time = block_time
+            self.first_scans = scans
+        self.last_time = block_time
+        self.scans += scans
+
+    #
+    # Percentiles (50, 90, 99, max) of the last window values
+    #
+    # Returns a dictionary
+    #
+
+    def percentiles(self, values, n):
+        values = values[:min(n, self.window)]
+        if len(values) == 0:
+            return None
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        return {'p50': p50, 'p90': p90, 'p99': p99,
+                'max': float(values.max())}
+
+    #
+    # Effective sampling rate from the block arrival times
+    #
+
+    def effective_Fs(self):
+        if self.first_time is None or self.last_time == self.first_time:
+            return None
+        return (self.scans - self.first_scans) / (self.last_time -
+                                                  self.first_time)
+
+    #
+    # Current state of all metrics
+    #
+    # Returns a dictionary (JSON serializable)
+    #
+
+    def snapshot(self):
+        hist = self.backlog_hist
+        last = max([k for k, n in enumerate(hist) if n] or [0])
+        elapsed = None
+        if self.first_time is not None:
+            elapsed = self.last_time - self.first_time
+        metrics = {'time': time.time(),
+                   'Fs': self.Fs,
+                   'effective_Fs': self.effective_Fs(),
+                   'nchan': self.nchan,
+                   'scans': self.scans,
+                   'elapsed': elapsed,
+                   'reads': self.reads,
+                   'blocks': self.blocks,
+                   'backlog_hist': hist[:last + 1],
+                   'max_backlog': self.max_backlog,
+                   'read_time': self.read_time,
+                   'busy_time': self.busy_time,
+                   'read_seconds': self.percentiles(self.read_times,
+                                                    self.reads),
+                   'block_latency': self.percentiles(self.block_latencies,
+                                                     self.blocks),
+                   'buffer_time': self.buffer_time,
+                   'overflows': self.overflows,
+                   'longest_gap': self.longest_gap}
+        acq = self.pipeline
+        if acq is not None:
+            metrics.update({'overruns': acq.overruns,
+                            'max_queued': acq.max_queued,
+                            'stalled': acq.stalled,
+                            'misaligned': acq.decoder.misaligned,
+                            'skipped_bytes': acq.decoder.skipped_bytes})
+        return metrics
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+            f.write('\n')
@@ -0,0 +1,254 @@
+#
+# Triggered capture.
+#
+# Instead of recording everything, triggered_capture keeps the last
+# `pre` seconds of scans in a ring buffer and, when the trigger fires,
+# writes that pre-trigger window followed by `post` seconds from the
+# trigger scan on.  Everything else is dropped, so sparse events cost
+# storage only for the windows around them.
+#
+# Triggers are evaluated on the decoded int16 stream (it is a pipeline
+# sink), carrying their state across blocks:
+#
+#     level    the channel at scan position `position` crosses `level`
+#              volts
+#     slope    the channel's slope reaches `level` V/s (in size, for
+#              'falling' and 'both')
+#     digital  digital input DI<level> changes (see digital.py)
+#
+# edge is 'rising', 'falling' or 'both'.
+#
+# Re-arm modes, after the post-trigger window (plus holdoff seconds):
+#
+#     auto       wait for the next trigger
+#     single     stop after the first event
+#     retrigger  like auto, but a trigger during the post window extends
+#                it by `post` seconds from that trigger
+#
+# max_events (if given) stops capturing after that many events.
+#
+# Windows go to a writer (wav_writer or compressed_writer): with
+# per_event=True each window is its own file, otherwise all windows are
+# records in one file, listed with their offsets in an .events.json file
+# next to it.  events holds one dictionary per window in both cases.
+#
+
+import json
+import os
+import numpy as np
+
+from dataq_utilities.digital import digital_bits
+from dataq_utilities.recording import to_volts
+
+KINDS = ['level', 'slope', 'digital']
+EDGES = ['rising', 'falling', 'both']
+REARM = ['auto', 'single', 'retrigger']
+
+#
+# Events filename of a recording
+#
+
+def events_name(filename):
+    return os.path.splitext(filename)[0] + '.events.json'
+
+#
+# Streaming trigger condition
+#
+
+class trigger:
+    def __init__(self, rate, kind='level', position=0, level=0.0,
+                 edge='rising'):
+        ''' Constructor for this class '''
+        if kind not in KINDS:
+            raise ValueError('trigger kind must be one of {}'.format(KINDS))
+        if edge not in EDGES:
+            raise ValueError('trigger edge must be one of {}'.format(EDGES))
+        self.rate = rate
+        self.kind = kind
+        self.position = position
+        self.level = level
+        self.edge = edge
+        self.condition = None
+        self.value = None
+
+    #
+    # Per-scan condition of a block; the trigger fires where it becomes
+    # true (or, for 'both' on level and digital triggers, changes)
+    #
+
+    def evaluate(self, samples):
+        column = samples[:, self.position]
+        if self.kind == 'digital':
+            return (digital_bits(column, int(self.level) + 1) >>
+                    int(self.level)) & 1 == (0 if self.edge == 'falling'
+                                             else 1)
+        v = to_volts(column.reshape(-1, 1), [self.position])[:, 0]
+        if self.kind == 'level':
+            return v <= self.level if self.edge == 'falling' \
+                else v >= self.level
+        previous = v[0] if self.value is None else self.value
+        self.value = v[-1]
+        slope = np.diff(np.concatenate(([previous], v))) * self.rate
+        if self.edge == 'rising':
+            return slope >= self.level
+        if self.edge == 'falling':
+            return slope <= -self.level
+        return np.abs(slope) >= self.level
+
+    #
+    # Scans of an (n, nchan) int16 block where the trigger fires
+    #
+    # Returns an int array of indices into the block
+    #
+
+    def find(self, samples):
+        if len(samples) == 0:
+            return np.zeros(0, np.intp)
+        c = self.evaluate(samples)
+        previous = c[0] if self.condition is None else self.condition
+        self.condition = c[-1]
+        x = np.concatenate(([previous], c))
+        if self.edge == 'both' and self.kind != 'slope':
+            return np.flatnonzero(x[1:] != x[:-1])
+        return np.flatnonzero(x[1:] & ~x[:-1])
+
+#
+# Last scans of the stream, in a fixed-size buffer
+#
+
+class ring:
+    def __init__(self, scans, nchan):
+        ''' Constructor for this class '''
+        self.buffer = np.zeros((scans, nchan), np.int16)
+        self.size = scans
+        self.count = 0
+        self.head = 0
+
+    def write(self, samples):
+        samples = samples[-self.size:] if self.size else samples[:0]
+        n = len(samples)
+        first = min(n, self.size - self.head)
+        self.buffer[self.head:self.head + first] = samples[:first]
+        self.buffer[:n - first] = samples[first:]
+        self.head = (self.head + n) % max(self.size, 1)
+        self.count = min(self.count + n, self.size)
+
+    #
+    # The last n scans (at most what is held), oldest first
+    #
+
+    def last(self, n):
+        n = min(n, self.count)
+        start = (self.head - n) % max(self.size, 1)
+        if start + n <= self.size:
+            return self.buffer[start:start + n].copy()
+        return np.concatenate((self.buffer[start:],
+                               self.buffer[:start + n - self.size]))
+
+
+class triggered_capture:
+    def __init__(self, writer, trigger, pre=0.1, post=0.4, rearm='auto',
+                 holdoff=0.0, max_events=None, per_event=True):
+        ''' Constructor for this class '''
+        if rearm not in REARM:
+            raise ValueError('rearm must be one of {}'.format(REARM))
+        self.writer = writer
+        self.trigger = trigger
+        self.rate = writer.rate
+        self.pre_scans = int(round(pre * self.rate))
+        self.post_scans = max(int(round(post * self.rate)), 1)
+        self.holdoff_scans = int(round(holdoff * self.rate))
+        self.rearm = rearm
+        self.max_events = 1 if rearm == 'single' else max_events
+        self.per_event = per_event
+        self.history = ring(self.pre_scans, writer.nchan)
+        self.scans = 0
+        self.armed_at = 0
+        self.end = None
+        self.events = []
+
+    def armed(self):
+        return self.max_events is None or len(self.events) < self.max_events
+
+    #
+    # Sink interface
+    #
+
+    def write(self, samples):
+        n = len(samples)
+        hits = self.trigger.find(samples) + self.scans
+        pos = self.scans
+        stop = self.scans + n
+        while pos < stop:
+            if self.end is not None:
+                # Post-trigger window
+                if self.rearm == 'retrigger':
+                    while True:
+                        later = hits[(hits > self.events[-1]['last_trigger'])
+                                     & (hits < self.end)]
+                        if not len(later):
+                            break
+                        self.events[-1]['last_trigger'] = int(later[-1])
+                        self.end = int(later[-1]) + self.post_scans
+                take = min(self.end, stop) - pos
+                self.writer.write(samples[pos - self.scans:
+                                          pos - self.scans + take])
+                self.events[-1]['scans'] += take
+                pos += take
+                if pos == self.end:
+                    self.finish_event()
+                continue
+            if not self.armed():
+                break
+            waiting = hits[hits >= max(pos, self.armed_at)]
+            if not len(waiting):
+                break
+            self.start_event(int(waiting[0]), samples)
+            pos = int(waiting[0])
+        self.history.write(samples)
+        self.scans = stop
+
+    #
+    # Write the pre-trigger window of a trigger at absolute scan hit
+    #
+
+    def start_event(self, hit, samples):
+        i = hit - self.scans
+        pre = samples[max(i - self.pre_scans, 0):i]
+        if len(pre) < self.pre_scans:
+            pre = np.concatenate((self.history.last(self.pre_scans -
+                                                     len(pre)), pre))
+        # File (counting from the writer's next one) and scan offset in it
+        opened = self.writer.f is not None
+        self.events.append({'trigger_scan': hit,
+                            'trigger_time': hit / float(self.rate),
+                            'start_scan': hit - len(pre),
+                            'pre_scans': len(pre),
+                            'scans': len(pre),
+                            'file': len(self.writer.files),
+                            'offset': self.writer.frames if opened else 0,
+                            'last_trigger': hit})
+        self.writer.write(pre)
+        self.end = hit + self.post_scans
+
+    def finish_event(self):
+        self.armed_at = self.end + self.holdoff_scans
+        self.end = None
+        if self.per_event:
+            self.writer.finish()
+
+    def close(self):
+        if self.end is not None:
+            # Acquisition ended inside a post-trigger window
+            self.events[-1]['truncated'] = True
+            self.end = None
+        self.writer.close()
+        files = self.writer.files
+        for event in self.events:
+            event['file'] = files[min(event['file'], len(files) - 1)]
+        if not self.per_event:
+            for filename in files:
+                with open(events_name(filename), 'w') as f:
+                    json.dump([e for e in self.events
+                               if e['file'] == filename], f, indent=2)
+                    f.write('\n')
@@ -0,0 +1,214 @@
+#
+# Streaming WAV writer.
+#
+# The header is written when a file is opened, int16 frames are appended
+# as blocks arrive and the RIFF/data sizes are patched when the file is
+# closed, so a recording is never held in memory.  Files roll over to a
+# new one at a size or time boundary and keep the Data_acq.py naming
+# convention:
+#
+#     date_SR<rate>_SL<samples>_CH<channels>_time.wav
+#
+# A JUNK chunk is reserved after the RIFF header.  If a file grows past
+# the 4 GB RIFF limit, that chunk becomes the ds64 chunk of an RF64 file
+# (EBU Tech 3306), which scipy.io.wavfile can read.
+#
+# With overview=True a min/max overview pyramid (overview.py), and with
+# edges=True an index of the digital input edges (digital.py), is built
+# as frames arrive and saved next to each file when it is finished.
+#
+
+import os
+import re
+import struct
+import numpy as np
+from datetime import datetime
+
+from dataq_utilities import digital, overview as overviews
+
+RIFF_LIMIT = 0xFFFFFFFF
+
+#
+# Recording filename from the Data_acq.py convention
+#
+# Returns a string
+#
+
+def wav_filename(rate, sequence_length, channel, when=None,
+                 extension='.wav'):
+    if when is None:
+        when = datetime.now()
+    channels = ''.join(map(str, channel))
+    return (when.strftime('%Y-%m-%d')+'_'+'SR'+str(rate)+'_'+
+            'SL'+str(sequence_length)+'_'+'CH'+channels+'_'+
+            when.strftime('%H-%M-%S')+extension)
+
+#
+# Metadata from a Data_acq.py recording filename (inverse of wav_filename)
+#
+# Returns a dictionary (date, time, when, rate, sequence_length,
+# channels), or None if the name does not follow the convention
+#
+
+FILENAME = re.compile(r'(\d{4}-\d{2}-\d{2})_SR(\d+)_SL(\d+)_CH(\d*)_'
+                      r'(\d{2}-\d{2}-\d{2})(?:_\d+)?'
+                      r'\.(?:wav|dqz)(?:\.part)?$')
+
+def parse_wav_filename(filename):
+    m = FILENAME.match(os.path.basename(filename))
+    if m is None:
+        return None
+    date, rate, length, channels, clock = m.groups()
+    return {'date': date,
+            'time': clock.replace('-', ':'),
+            'when': datetime.strptime(date + ' ' + clock,
+                                      '%Y-%m-%d %H-%M-%S'),
+            'rate': int(rate),
+            'sequence_length': int(length),
+            'channels': [int(c) for c in channels]}
+
+
+class wav_writer:
+    EXTENSION = '.wav'
+
+    def __init__(self, rate, channel, directory='.', max_bytes=None,
+                 max_seconds=None, overview=False, edges=False):
+        ''' Constructor for this class '''
+        self.rate = rate
+        self.channel = list(channel)
+        self.nchan = len(self.channel)
+        self.directory = directory
+        self.frame_bytes = 2 * self.nchan
+
+        # Rollover boundary in frames (None: never roll over)
+        limits = []
+        if max_bytes is not None:
+            limits.append(max(max_bytes // self.frame_bytes, 1))
+        if max_seconds is not None:
+            limits.append(max(int(max_seconds * rate), 1))
+        self.max_frames = min(limits) if limits else None
+
+        self.overview = overview
+        self.pyramid = None
+        self.edges = edges
+        self.edge_index = None
+
+        self.f = None
+        self.frames = 0
+        self.total_frames = 0
+        self.files = []
+
+    #
+    # Open a new file
+    #
+
+    def open(self):
+        self.started = datetime.now()
+        self.partname = os.path.join(self.directory,
+                                     wav_filename(self.rate, 0, self.channel,
+                                                  self.started,
+                                                  self.EXTENSION) + '.part')
+        self.f = open(self.partname, 'wb')
+        self.start_file()
+        self.frames = 0
+        if self.overview:
+            self.pyramid = overviews.minmax_pyramid(self.nchan, self.rate)
+        if self.edges:
+            self.edge_index = digital.edge_index(self.rate)
+
+    #
+    # Start the new file (a header with zero sizes)
+    #
+
+    def start_file(self):
+        self.f.write(self.header(0))
+
+    #
+    # Append frames to the open file
+    #
+
+    def append(self, samples):
+        self.f.write(np.ascontiguousarray(samples, dtype='<i2'))
+
+    #
+    # Complete the open file before it is closed
+    #
+
+    def end_file(self):
+        self.f.seek(0)
+        self.f.write(self.header(self.frames * self.frame_bytes))
+
+    #
+    # RIFF or RF64 header for data_bytes of frames
+    #
+    # Returns bytes (always 80 bytes long)
+    #
+
+    def header(self, data_bytes):
+        rf64 = data_bytes + 72 > RIFF_LIMIT
+        h = b'RF64' if rf64 else b'RIFF'
+        h += struct.pack('<I', RIFF_LIMIT if rf64 else data_bytes + 72)
+        h += b'WAVE'
+        if rf64:
+            h += b'ds64' + struct.pack('<IQQQI', 28, data_bytes + 72,
+                                       data_bytes, data_bytes //
+                                       self.frame_bytes, 0)
+        else:
+            h += b'JUNK' + struct.pack('<I', 28) + bytes(28)
+        h += b'fmt ' + struct.pack('<IHHIIHH', 16, 1, self.nchan, self.rate,
+                                   self.rate * self.frame_bytes,
+                                   self.frame_bytes, 16)
+        h += b'data' + struct.pack('<I', RIFF_LIMIT if rf64 else data_bytes)
+        return h
+
+    #
+    # Patch the sizes, rename the file to its final name
+    #
+
+    def finish(self):
+        if self.f is None:
+            return
+        self.end_file()
+        self.f.close()
+        self.f = None
+        filename = os.path.join(self.directory,
+                                wav_filename(self.rate, self.frames,
+                                             self.channel, self.started,
+                                             self.EXTENSION))
+        base, n = filename[:-len(self.EXTENSION)], 1
+        while os.path.exists(filename):
+            filename = '{}_{}{}'.format(base, n, self.EXTENSION)
+            n += 1
+        os.rename(self.partname, filename)
+        self.files.append(filename)
+        if self.pyramid is not None:
+            self.pyramid.save(overviews.sidecar_name(filename))
+            self.pyramid = None
+        if self.edge_index is not None:
+            self.edge_index.save(digital.sidecar_name(filename))
+            self.edge_index = None
+
+    #
+    # Sink interface
+    #
+
+    def write(self, samples):
+        while len(samples):
+            if self.f is None:
+                self.open()
+            n = len(samples)
+            if self.max_frames is not None:
+                n = min(n, self.max_frames - self.frames)
+            self.append(samples[:n])
+            if self.pyramid is not None:
+                self.pyramid.write(samples[:n])
+            if self.edge_index is not None:
+                self.edge_index.write(samples[:n])
+            self.frames += n
+            self.total_frames += n
+            samples = samples[n:]
+            if self.max_frames is not None and self.frames >= self.max_frames:
+                self.finish()
+
+    def close(self):
+        self.finish()